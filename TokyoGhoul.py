@@ -1,46 +1,598 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import sqlite3
 import datetime
-
-intents = discord.Intents.default()
-intents.members = True
-intents.message_content = True
-intents.messages = True
-intents.guilds = True
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-# Connect to SQLite database
-conn = sqlite3.connect("bank.db")
-c = conn.cursor()
-
-# Create tables if not exists
-c.execute('''CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                AP INTEGER DEFAULT 0,
-                SP INTEGER DEFAULT 0,
-                yen INTEGER DEFAULT 0,
-                reputation INTEGER DEFAULT 0
-            )''')
-
-c.execute('''CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                type TEXT,
-                amount INTEGER,
-                currency TEXT,
-                reason TEXT,
-                timestamp TEXT,
-                status TEXT DEFAULT NULL
-            )''')
-conn.commit()
-
-# Valid currency types
-CURRENCY_TYPES = ["AP", "SP", "YEN", "REPUTATION"]
-
-
-
-@bot.event
+import os
+import subprocess
+import sys
+import tempfile
+import asyncio
+import contextlib
+import threading
+import time
+import typing
+from aiohttp import web
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import reconcile as reconciliation
+import bulk
+import ledger
+
+# Sharding: with SHARD_PROCESSES > 1, running this file starts that many worker processes, and
+# process k owns shards k, k + SHARD_PROCESSES, ... of SHARD_COUNT. A guild's events only
+# reach the process that owns its shard, so each guild database is written by one process.
+SHARD_PROCESSES = int(os.environ.get("BANK_SHARD_PROCESSES", "1"))
+SHARD_COUNT = int(os.environ["BANK_SHARD_COUNT"]) if os.environ.get("BANK_SHARD_COUNT") else None  # None: Discord's recommendation
+SHARD_PROCESS = int(os.environ["BANK_SHARD_PROCESS"]) if os.environ.get("BANK_SHARD_PROCESS") else None  # set in worker processes
+
+# Performance metrics: latency histograms per command, per database unit of work and per
+# outbound message, shown by !perfstats and served in Prometheus format on 127.0.0.1:METRICS_PORT.
+# BANK_METRICS_PORT overrides the port; "off" disables the endpoint.
+_metrics_port = os.environ.get("BANK_METRICS_PORT", "9108")
+METRICS_PORT = None if _metrics_port.lower() == "off" else int(_metrics_port)  # shard process k listens on METRICS_PORT + k
+SLOW_QUERY_THRESHOLD = 0.25  # seconds; units of work slower than this are logged. None disables.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()  # database timings are recorded from the worker thread
+
+    def observe(self, seconds):
+        index = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    # Upper bucket bound containing the given quantile (an estimate, like Prometheus does)
+    def quantile(self, q):
+        with self.lock:
+            target = q * self.count
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.counts):
+                seen += count
+                if seen >= target and seen:
+                    return bound
+        return 0.0
+
+metrics = {"command": {}, "db": {}, "send": {}}
+command_errors = {}
+
+def observe(kind, name, seconds):
+    histogram = metrics[kind].get(name)
+    if histogram is None:
+        histogram = metrics[kind].setdefault(name, Histogram())
+    histogram.observe(seconds)
+
+# Each guild's bank is its own SQLite database, DB_DIRECTORY/<guild_id>.db, so balances never
+# leak between servers and each guild's writes go to a separate file. A bank.db from before
+# per-guild storage keeps serving the guild whose ID is set in BANK_DB_GUILD (or, without
+# it, the only guild of a single-guild bot; see adopt_legacy_database).
+# Nothing is opened at import: a guild's database is connected on its first command.
+DB_DIRECTORY = os.environ.get("BANK_DB_DIR", "guilds")
+DB_PATH = os.environ.get("BANK_DB_PATH", "bank.db")
+LEGACY_GUILD_ID = int(os.environ["BANK_DB_GUILD"]) if os.environ.get("BANK_DB_GUILD") else None
+# Settled transactions older than ARCHIVE_AFTER_DAYS can be moved by !archive into an
+# attached <database>-archive.db, keeping the hot transactions table small
+ARCHIVE_PATH = os.environ.get("BANK_ARCHIVE_PATH", os.path.splitext(DB_PATH)[0] + "-archive.db")
+ARCHIVE_AFTER_DAYS = 90
+LEADERBOARD_MAX = 25  # rows !leaderboard will show
+HISTORY_MAX = 100  # transactions !history will page through
+ECONOMY_DAYS = 7  # days of deposit/spend volume !economy reports
+# Reconciliation replays the ledger from the latest balance snapshot in a pool of
+# RECONCILE_WORKERS processes, every RECONCILE_INTERVAL_HOURS and on !reconcile.
+# A new snapshot is only taken once the balances agree with the ledger.
+RECONCILE_WORKERS = os.cpu_count() or 1
+RECONCILE_INTERVAL_HOURS = 24
+# Scheduled payouts are checked for every PAYOUT_POLL_SECONDS; runs missed while the bot
+# was down are caught up, oldest first, on the next check
+PAYOUT_POLL_SECONDS = 60
+PAYOUT_INTERVALS = {"hourly": 3_600_000, "daily": 86_400_000, "weekly": 604_800_000}
+PAYOUT_INTERVAL_UNITS = {"h": 3_600_000, "d": 86_400_000, "w": 604_800_000}
+SNAPSHOTS_KEPT = 7
+# !import stages IMPORT_CHUNK_SIZE records per unit of work, so commands keep running
+# between chunks, then applies the whole file in one set-based unit of work
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_CACHE_KIB = 131072  # SQLite page cache while applying, so index updates don't spill to disk
+# PRAGMA synchronous level for the WAL journal. FULL fsyncs every group commit, so an
+# acknowledged command survives power loss; NORMAL is faster but may lose the last commits.
+DB_SYNCHRONOUS = "FULL"
+# Group commit: writes from concurrent commands share one COMMIT, issued after
+# COMMIT_INTERVAL seconds or once COMMIT_BATCH_SIZE units of work are waiting.
+COMMIT_INTERVAL = 0.005
+COMMIT_BATCH_SIZE = 100
+MAX_OPEN_PARTITIONS = 64
+# Reporting reads (!viewallbalances, !view_pending, the history pages) run on a pool of
+# READ_POOL_SIZE read-only connections per guild, each read in its own WAL snapshot, so a
+# long report never holds up the worker thread's writes. One that runs past READ_TIMEOUT
+# seconds is interrupted.
+READ_POOL_SIZE = 2
+READ_TIMEOUT = 10.0
+
+# Schema migrations, applied in order. PRAGMA user_version records the last one applied,
+# so add new steps to the end of this list and never edit one that has shipped.
+MIGRATIONS = [
+    # 1: base tables
+    ['''CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            AP INTEGER DEFAULT 0,
+            SP INTEGER DEFAULT 0,
+            yen INTEGER DEFAULT 0,
+            reputation INTEGER DEFAULT 0
+        )''',
+     '''CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            type TEXT,
+            amount INTEGER,
+            currency TEXT,
+            reason TEXT,
+            timestamp TEXT,
+            status TEXT DEFAULT NULL
+        )'''],
+    # 2: indexes for history (user_id ORDER BY id), the pending queue and approve/reject lookups
+    ["CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, id)",
+     "CREATE INDEX IF NOT EXISTS idx_transactions_pending ON transactions (id) WHERE status = 'PENDING'",
+     "CREATE INDEX IF NOT EXISTS idx_transactions_deposit ON transactions (user_id, reason, type, status)"],
+    # 3: timestamps become INTEGER epoch milliseconds (the old TEXT values were local time),
+    # and history is indexed by (user_id, timestamp) for date-range queries
+    ['''CREATE TABLE transactions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            type TEXT,
+            amount INTEGER,
+            currency TEXT,
+            reason TEXT,
+            timestamp INTEGER,
+            status TEXT DEFAULT NULL
+        )''',
+     """INSERT INTO transactions_new (id, user_id, type, amount, currency, reason, timestamp, status)
+        SELECT id, user_id, type, amount, currency, reason,
+               COALESCE(CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000, 0), status
+        FROM transactions""",
+     "DROP TABLE transactions",
+     "ALTER TABLE transactions_new RENAME TO transactions",
+     "CREATE INDEX idx_transactions_user_time ON transactions (user_id, timestamp)",
+     "CREATE INDEX idx_transactions_pending ON transactions (id) WHERE status = 'PENDING'",
+     "CREATE INDEX idx_transactions_deposit ON transactions (user_id, reason, type, status)"],
+    # 4: per-user totals of archived transactions (status '' stands for NULL)
+    ['''CREATE TABLE transaction_summaries (
+            user_id INTEGER,
+            currency TEXT,
+            type TEXT,
+            status TEXT,
+            total INTEGER DEFAULT 0,
+            count INTEGER DEFAULT 0,
+            archived_through INTEGER,
+            PRIMARY KEY (user_id, currency, type, status)
+        )'''],
+    # 5: balance snapshots for reconciliation. through_id is the last transaction ID a
+    # snapshot includes; snapshot_pending lists the deposits that were still pending then.
+    ['''CREATE TABLE balance_snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            taken_at INTEGER,
+            through_id INTEGER
+        )''',
+     '''CREATE TABLE snapshot_balances (
+            snapshot_id INTEGER,
+            user_id INTEGER,
+            AP INTEGER,
+            SP INTEGER,
+            yen INTEGER,
+            reputation INTEGER,
+            PRIMARY KEY (snapshot_id, user_id)
+        )''',
+     '''CREATE TABLE snapshot_pending (
+            snapshot_id INTEGER,
+            transaction_id INTEGER,
+            PRIMARY KEY (snapshot_id, transaction_id)
+        )'''],
+    # 6: leaderboards read the top of a per-currency index, and the economy aggregates
+    # are kept up to date by every balance change instead of scanning users/transactions.
+    # economy_daily is bucketed by UTC day (timestamp // 86400000); existing history is
+    # backfilled from live transactions, with deposits counted on the day they were made.
+    ["CREATE INDEX idx_users_ap ON users (AP DESC, user_id)",
+     "CREATE INDEX idx_users_sp ON users (SP DESC, user_id)",
+     "CREATE INDEX idx_users_yen ON users (yen DESC, user_id)",
+     "CREATE INDEX idx_users_reputation ON users (reputation DESC, user_id)",
+     '''CREATE TABLE economy_totals (
+            currency TEXT PRIMARY KEY,
+            supply INTEGER DEFAULT 0
+        )''',
+     '''INSERT INTO economy_totals (currency, supply)
+        SELECT 'AP', COALESCE(SUM(AP), 0) FROM users
+        UNION ALL SELECT 'SP', COALESCE(SUM(SP), 0) FROM users
+        UNION ALL SELECT 'YEN', COALESCE(SUM(yen), 0) FROM users
+        UNION ALL SELECT 'REPUTATION', COALESCE(SUM(reputation), 0) FROM users''',
+     '''CREATE TABLE economy_daily (
+            day INTEGER,
+            currency TEXT,
+            deposited INTEGER DEFAULT 0,
+            spent INTEGER DEFAULT 0,
+            PRIMARY KEY (day, currency)
+        )''',
+     '''INSERT INTO economy_daily (day, currency, deposited, spent)
+        SELECT timestamp / 86400000, UPPER(currency),
+               SUM(CASE WHEN type = 'deposit' THEN amount ELSE 0 END),
+               SUM(CASE WHEN type = 'spend' THEN amount ELSE 0 END)
+        FROM transactions
+        WHERE type = 'spend' OR (type = 'deposit' AND UPPER(status) = 'APPROVED')
+        GROUP BY timestamp / 86400000, UPPER(currency)'''],
+    # 7: scheduled payouts. A schedule pays a fixed amount (kind 'payout') or interest in
+    # basis points of the balance (kind 'interest', negative for decay) to everyone or to a
+    # role's members every interval_ms. Each run is one payout_runs row plus one summary
+    # ledger row (ledger_id, user_id NULL); what each user got is kept in payout_credits,
+    # which reconciliation replays like ledger rows. UNIQUE (schedule_id, due_at) makes a run
+    # happen at most once.
+    ['''CREATE TABLE payout_schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            currency TEXT,
+            amount INTEGER,
+            role_id INTEGER,
+            interval_ms INTEGER,
+            next_run INTEGER,
+            reason TEXT,
+            created_by INTEGER,
+            active INTEGER DEFAULT 1
+        )''',
+     '''CREATE TABLE payout_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            schedule_id INTEGER,
+            due_at INTEGER,
+            ran_at INTEGER,
+            currency TEXT,
+            ledger_id INTEGER,
+            users INTEGER,
+            total INTEGER,
+            UNIQUE (schedule_id, due_at)
+        )''',
+     '''CREATE TABLE payout_credits (
+            run_id INTEGER,
+            user_id INTEGER,
+            amount INTEGER,
+            PRIMARY KEY (run_id, user_id)
+        ) WITHOUT ROWID'''],
+]
+
+def _migrate(c):
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        c.execute("BEGIN")
+        try:
+            for statement in statements:
+                c.execute(statement)
+            c.execute(f"PRAGMA user_version={number}")
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        print(f"Applied schema migration {number}")
+
+# Returns (database, archive) file paths for a guild
+def database_paths(guild_id):
+    if guild_id == LEGACY_GUILD_ID:
+        return DB_PATH, ARCHIVE_PATH
+    path = os.path.join(DB_DIRECTORY, f"{guild_id}.db")
+    return path, os.path.splitext(path)[0] + "-archive.db"
+
+# Worker-thread state. Every guild database is served by its own worker thread, which keeps
+# that guild's connection and balance cache here; code running on a worker thread (the
+# _functions and each repository function's work()) reaches them through db.
+db = threading.local()
+
+def _connect(path, archive_path):
+    # Connect to SQLite database (opened on the worker thread that will use it)
+    # isolation_level=None: transactions are opened and committed explicitly by the group committer
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    db.conn = sqlite3.connect(path, isolation_level=None)
+    db.c = db.conn.cursor()
+    db.c.execute("PRAGMA journal_mode=WAL")
+    db.c.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+
+    # The archive lives in its own file; its schema is created here rather than by a
+    # migration so a missing archive file is simply recreated empty
+    db.c.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    # WAL for the archive too, so the read-only reader pool never blocks on (or blocks) the worker
+    db.c.execute("PRAGMA archive.journal_mode=WAL")
+    db.c.execute('''CREATE TABLE IF NOT EXISTS archive.transactions (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    type TEXT,
+                    amount INTEGER,
+                    currency TEXT,
+                    reason TEXT,
+                    timestamp INTEGER,
+                    status TEXT
+                )''')
+    db.c.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_user_time ON transactions (user_id, timestamp)")
+
+    # Bring the schema up to date
+    _migrate(db.c)
+
+    # Write-through LRU cache of whole users rows ({currency: amount}), keyed by user_id.
+    # Only touched from this worker thread, so it needs no locking.
+    db.balance_cache = OrderedDict()
+    db.balance_cache_stats = {"hits": 0, "misses": 0}
+
+    # Every group-commit transaction opened on this connection gets the next generation;
+    # the ones whose COMMIT failed are remembered with their error (see _commit_open)
+    db.generation = 0
+    db.failed_generations = OrderedDict()
+    return db.balance_cache, db.balance_cache_stats
+
+def _close():
+    _commit_open()
+    db.conn.close()
+
+# Opens a reader thread's read-only connection. The schema is already migrated by the
+# worker thread's _connect by then. Reader threads have no balance cache.
+def _connect_reader(path, archive_path, connections):
+    # check_same_thread=False only so Partition.close can close it once the pool is idle
+    db.conn = ledger.connect_readonly(path, archive_path, check_same_thread=False)[0]
+    db.c = db.conn.cursor()
+    # Statement timeout: SQLite calls this every 10000 VM steps and aborts the statement
+    # (OperationalError: interrupted) once the read's deadline has passed
+    db.deadline = float("inf")
+    db.conn.set_progress_handler(lambda: time.monotonic() > db.deadline, 10000)
+    connections.append(db.conn)
+
+BALANCE_CACHE_SIZE = 10000  # rows per guild
+
+# One guild's database: its worker thread, plus its group-commit state on the event loop side
+class Partition:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.path, self.archive_path = database_paths(guild_id)
+        # All of the guild's SQLite work runs on this single worker thread so a slow query or
+        # commit never blocks the discord.py event loop. One thread also keeps writes serialized.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bank-db-{guild_id}")
+        # Submitted first, so the connection is open before any unit of work runs
+        self.opened = self.executor.submit(_connect, self.path, self.archive_path)
+        self.in_flight = 0
+        self.commit_waiters = []
+        self.read_waiters = []  # reads that saw uncommitted units, released by the same commit
+        self.commit_timer = None
+        # Read-only connections for run_read, opened on first use
+        self.readers = None
+        self.reader_connections = []
+
+    def failed(self):
+        return self.opened.done() and self.opened.exception() is not None
+
+    def reader_pool(self):
+        if self.readers is None:
+            self.readers = ThreadPoolExecutor(max_workers=READ_POOL_SIZE, thread_name_prefix=f"bank-read-{self.guild_id}",
+                                              initializer=_connect_reader,
+                                              initargs=(self.path, self.archive_path, self.reader_connections))
+        return self.readers
+
+    def close(self):
+        if not self.failed():
+            self.executor.submit(_close)
+        self.executor.shutdown(wait=False)
+        # Only closed when nothing is in flight, so no reader is mid-query
+        if self.readers is not None:
+            self.readers.shutdown(wait=False)
+            for conn in self.reader_connections:
+                conn.close()
+
+# Registry of open guild databases, least recently used first. Past MAX_OPEN_PARTITIONS the
+# idle ones are closed, bounding open files and threads; they reopen on their next use.
+partitions = OrderedDict()
+
+def get_partition(guild_id):
+    partition = partitions.get(guild_id)
+    if partition is None or partition.failed():
+        # Not open yet, or it failed to open last time and is retried
+        if partition is not None:
+            partition.close()
+        partition = partitions[guild_id] = Partition(guild_id)
+        for other_id, other in list(partitions.items()):
+            if len(partitions) <= MAX_OPEN_PARTITIONS:
+                break
+            if other is not partition and not other.in_flight and not other.commit_waiters and not other.read_waiters:
+                del partitions[other_id]
+                other.close()
+    partitions.move_to_end(guild_id)
+    return partition
+
+async def _run_on(partition, func, *args):
+    partition.in_flight += 1
+    try:
+        await asyncio.wrap_future(partition.opened)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(partition.executor, _timed, func, *args)
+    finally:
+        partition.in_flight -= 1
+
+# Run a blocking database function on a guild's worker thread and await its result. It may
+# see units of work whose group commit is still pending, so if any were, it only returns
+# once they are committed: nothing it read can be rolled back by a failed commit later.
+async def run_db(guild_id, func, *args):
+    partition = get_partition(guild_id)
+    result, pending = await _run_on(partition, _run_query, func, *args)
+    if pending is not None:
+        await _await_commit(partition, partition.read_waiters, pending)
+    return result
+
+# Returns (result, generation of the open group-commit transaction or None if there is none)
+def _run_query(func, *args):
+    return func(*args), _open_generation()
+
+def _open_generation():
+    return db.generation if db.conn.in_transaction else None
+
+# Run a read-only function on one of a guild's reader connections and await its result.
+# It sees the database as of its first statement and may not write.
+async def run_read(guild_id, func, *args):
+    partition = get_partition(guild_id)
+    partition.in_flight += 1
+    try:
+        await asyncio.wrap_future(partition.opened)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(partition.reader_pool(), _timed, _run_read, func, *args)
+    finally:
+        partition.in_flight -= 1
+
+class QueryTimeout(commands.CommandError):
+    pass
+
+# Run a read on a reader thread inside one read transaction, with a READ_TIMEOUT deadline
+def _run_read(func, *args):
+    db.deadline = time.monotonic() + READ_TIMEOUT
+    db.c.execute("BEGIN")
+    try:
+        return func(*args)
+    except sqlite3.OperationalError:
+        if time.monotonic() > db.deadline:
+            raise QueryTimeout(f"The report took longer than {READ_TIMEOUT:g} s and was stopped. Try a narrower one.") from None
+        raise
+    finally:
+        db.deadline = float("inf")
+        if db.conn.in_transaction:
+            db.c.execute("COMMIT")
+
+# Time a unit of work on a worker or reader thread; its shape is the repository function it came from
+def _timed(func, *args):
+    target = args[0] if func in (_run_unit, _run_read, _run_query) else func
+    shape = target.__qualname__.split(".")[0]
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        elapsed = time.perf_counter() - started
+        observe("db", shape, elapsed)
+        if SLOW_QUERY_THRESHOLD is not None and elapsed > SLOW_QUERY_THRESHOLD:
+            print(f"Slow query: {shape} took {elapsed * 1000:.1f} ms")
+
+# Run one unit of work inside the open group-commit transaction, under its own savepoint
+# so a failing unit rolls back alone. A unit that opened the transaction and changed
+# nothing ends it again, rather than holding the write lock until some later commit.
+# Returns (result, whether it changed anything, generation of the transaction still open
+# with uncommitted units, or None).
+def _run_unit(func, *args):
+    opened = not db.conn.in_transaction
+    if opened:
+        db.generation += 1
+        # IMMEDIATE takes the write lock up front instead of upgrading mid-transaction
+        db.c.execute("BEGIN IMMEDIATE")
+    changes = db.conn.total_changes
+    db.c.execute("SAVEPOINT unit")
+    try:
+        result = func(*args)
+    except Exception:
+        db.c.execute("ROLLBACK TO unit")
+        db.c.execute("RELEASE unit")
+        if opened:
+            db.c.execute("COMMIT")
+        # Cached rows may hold the undone changes
+        db.balance_cache.clear()
+        raise
+    db.c.execute("RELEASE unit")
+    wrote = db.conn.total_changes != changes
+    if opened and not wrote:
+        db.c.execute("COMMIT")
+    return result, wrote, _open_generation()
+
+FAILED_GENERATIONS_KEPT = 64
+
+# Commit the open group-commit transaction, if any. A failed commit rolls back every unit
+# in it, so its generation is remembered as failed: units whose waiters only register
+# after this commit was flushed still learn that their writes are gone.
+def _commit_open():
+    if not db.conn.in_transaction:
+        return
+    try:
+        db.c.execute("COMMIT")
+    except Exception as error:
+        db.conn.rollback()
+        db.balance_cache.clear()
+        db.failed_generations[db.generation] = error
+        while len(db.failed_generations) > FAILED_GENERATIONS_KEPT:
+            db.failed_generations.popitem(last=False)
+        raise
+
+# Commit whatever is open, then return {generation: error, or None if it was committed} for
+# the given generations. Each is either the one just committed or an earlier one, whose
+# outcome is already settled.
+def _commit_generations(generations):
+    try:
+        _commit_open()
+    except Exception:
+        pass  # recorded in failed_generations
+    return {generation: db.failed_generations.get(generation) for generation in generations}
+
+commit_stats = {"commits": 0, "writes": 0, "max_batch": 0, "last_batch": 0}  # all guilds
+
+def _flush_commits(partition):
+    if partition.commit_timer is not None:
+        partition.commit_timer.cancel()
+        partition.commit_timer = None
+    waiters = partition.commit_waiters[:]
+    partition.commit_waiters.clear()
+    commit_stats["commits"] += 1
+    commit_stats["writes"] += len(waiters)
+    commit_stats["last_batch"] = len(waiters)
+    commit_stats["max_batch"] = max(commit_stats["max_batch"], len(waiters))
+    # Reads waiting on the same commit aren't counted as writes
+    waiters += partition.read_waiters
+    partition.read_waiters.clear()
+    # In flight from now on, so the partition isn't closed before its commit has run
+    partition.in_flight += 1
+    asyncio.ensure_future(_commit_batch(partition, waiters))
+
+# Waiters are (generation, future): a future fails with the error of its own generation's
+# commit, whichever batch it ends up in
+async def _commit_batch(partition, waiters):
+    partition.in_flight -= 1
+    try:
+        outcomes = await _run_on(partition, _commit_generations, {generation for generation, _ in waiters})
+    except Exception as error:
+        outcomes = dict.fromkeys((generation for generation, _ in waiters), error)
+    for generation, waiter in waiters:
+        if waiter.done():
+            continue
+        if outcomes[generation] is not None:
+            waiter.set_exception(outcomes[generation])
+        else:
+            waiter.set_result(None)
+
+# Wait until the group-commit transaction of the given generation has been committed,
+# joining waiters (the guild's writes or its reads)
+async def _await_commit(partition, waiters, generation):
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    waiters.append((generation, waiter))
+    if len(partition.commit_waiters) >= COMMIT_BATCH_SIZE:
+        _flush_commits(partition)
+    elif partition.commit_timer is None:
+        partition.commit_timer = loop.call_later(COMMIT_INTERVAL, _flush_commits, partition)
+    await waiter
+
+# Run a unit of work that may write, and only return once its changes are committed.
+# A unit that didn't write waits like a run_db read if it may have seen uncommitted units.
+async def run_write(guild_id, func, *args):
+    partition = get_partition(guild_id)
+    result, wrote, pending = await _run_on(partition, _run_unit, func, *args)
+    if wrote:
+        await _await_commit(partition, partition.commit_waiters, pending)
+    elif pending is not None:
+        await _await_commit(partition, partition.read_waiters, pending)
+    return result
+
+def commit_stats_info():
+    average = commit_stats["writes"] / commit_stats["commits"] if commit_stats["commits"] else 0
+    return {**commit_stats, "average_batch": round(average, 2)}
+
+# Valid currency types, and the users column holding each
+CURRENCY_TYPES = ledger.CURRENCY_TYPES
+CURRENCY_COLUMNS = ledger.CURRENCY_COLUMNS
+
+# Bot-wide hooks, registered on the bot by create_bot
 async def on_command_error(ctx, error):
     # Check for command errors
     if isinstance(error, commands.CommandNotFound):
@@ -48,7 +600,14 @@ async def on_command_error(ctx, error):
     elif isinstance(error, commands.MissingRequiredArgument):
         await send_embed(ctx, "Error", f"❌ Missing required argument. Please check the command usage.")
     elif isinstance(error, commands.BadArgument):
-        await send_embed(ctx, "Error", f"❌ Invalid argument provided. Please check the command format.")
+        # The reason (a converter's, or a command's own such as a bad date) says what to fix
+        await send_embed(ctx, "Error", f"❌ Invalid argument provided: {error}")
+    elif isinstance(error, Throttled):
+        await send_embed(ctx, "Slow Down", f"⏳ {error}")
+    elif isinstance(error, QueryTimeout):
+        await send_embed(ctx, "Timed Out", f"⌛ {error}")
+    elif isinstance(error, commands.NoPrivateMessage):
+        await send_embed(ctx, "Error", "❌ Bank commands can only be used in a server.")
     elif isinstance(error, commands.MissingPermissions):
         await send_embed(ctx, "Error", "❌ You don't have the required permissions to use this command.")
     else:
@@ -56,47 +615,1271 @@ async def on_command_error(ctx, error):
 
     # Prevent the bot from crashing
     print(f"Error occurred: {error}")
-
-
-
+    name = ctx.command.qualified_name if ctx.command else "unknown"
+    command_errors[name] = command_errors.get(name, 0) + 1
+
+# Time every command from invoke to return
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
+async def stop_command_timer(ctx):
+    observe("command", ctx.command.qualified_name, time.perf_counter() - ctx.started_at)
+
+# Prometheus text format for every histogram plus the cache and commit counters
+def render_metrics():
+    lines = []
+    names = {"command": ("tokyo_command_latency_seconds", "command"),
+             "db": ("tokyo_db_latency_seconds", "query"),
+             "send": ("tokyo_send_latency_seconds", "call")}
+    for kind, (metric, label) in names.items():
+        lines.append(f"# TYPE {metric} histogram")
+        for name, histogram in sorted(metrics[kind].items()):
+            with histogram.lock:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.total}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+    lines.append("# TYPE tokyo_command_errors_total counter")
+    for name, count in sorted(command_errors.items()):
+        lines.append(f'tokyo_command_errors_total{{command="{name}"}} {count}')
+    cache = balance_cache_info()
+    lines.append("# TYPE tokyo_balance_cache_hits_total counter")
+    lines.append(f"tokyo_balance_cache_hits_total {cache['hits']}")
+    lines.append("# TYPE tokyo_balance_cache_misses_total counter")
+    lines.append(f"tokyo_balance_cache_misses_total {cache['misses']}")
+    commits = commit_stats_info()
+    lines.append("# TYPE tokyo_group_commits_total counter")
+    lines.append(f"tokyo_group_commits_total {commits['commits']}")
+    lines.append("# TYPE tokyo_group_commit_writes_total counter")
+    lines.append(f"tokyo_group_commit_writes_total {commits['writes']}")
+    lines.append("# TYPE tokyo_admission_total counter")
+    for outcome in ("admitted", "throttled", "busy"):
+        lines.append(f'tokyo_admission_total{{outcome="{outcome}"}} {admission_stats[outcome]}')
+    lines.append("# TYPE tokyo_admission_in_flight gauge")
+    lines.append(f"tokyo_admission_in_flight {admission_stats['in_flight']}")
+    lines.append("# TYPE tokyo_admission_waiting gauge")
+    lines.append(f"tokyo_admission_waiting {admission_stats['waiting']}")
+    return "\n".join(lines) + "\n"
+
+async def metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+async def start_metrics_server():
+    port = METRICS_PORT + (SHARD_PROCESS or 0)
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+    except OSError as e:
+        # Metrics are optional: a taken port must not stop the bank from starting
+        await runner.cleanup()
+        print(f"WARNING: metrics endpoint not started, cannot listen on 127.0.0.1:{port}: {e}")
+        return None
+    print(f"Metrics available on http://127.0.0.1:{port}/metrics")
+    return runner
 
 # Check if user has administrator permission
 
 def is_admin(ctx):
     return ctx.author.guild_permissions.administrator
 
-# Function to get user balance
-
-def get_balance(user_id, currency):
-    c.execute(f"SELECT {currency} FROM users WHERE user_id=?", (user_id,))
-    result = c.fetchone()
-    if result:
-        return result[0]
-    else:
-        c.execute("INSERT INTO users (user_id, AP, SP, yen, reputation) VALUES (?, 0, 0, 0, 0)", (user_id,))
-        conn.commit()
-        return 0
-
-# Function to store transaction history
-def log_transaction(user_id, trans_type, amount, currency, reason=""):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp) VALUES (?, ?, ?, ?, ?, ?)", 
+# Function to get a user's whole balance row, or None if they have none yet. Cache hits
+# run no SQL at all (worker thread only)
+def _find_balances(user_id):
+    row = db.balance_cache.get(user_id)
+    if row is not None:
+        db.balance_cache.move_to_end(user_id)
+        db.balance_cache_stats["hits"] += 1
+        return row
+
+    db.balance_cache_stats["misses"] += 1
+    db.c.execute("SELECT AP, SP, yen, reputation FROM users WHERE user_id=?", (user_id,))
+    result = db.c.fetchone()
+    if not result:
+        return None
+    return _cache_balances(user_id, result)
+
+def _cache_balances(user_id, balances):
+    row = dict(zip(CURRENCY_TYPES, balances))
+    db.balance_cache[user_id] = row
+    if len(db.balance_cache) > BALANCE_CACHE_SIZE:
+        db.balance_cache.popitem(last=False)
+    return row
+
+# Function to get a user's whole balance row, creating it if needed (worker thread only)
+def _get_balances(user_id):
+    row = _find_balances(user_id)
+    if row is None:
+        db.c.execute("INSERT INTO users (user_id, AP, SP, yen, reputation) VALUES (?, 0, 0, 0, 0)", (user_id,))
+        row = _cache_balances(user_id, (0, 0, 0, 0))
+    return row
+
+# Function to get user balance (worker thread only)
+def _get_balance(user_id, currency):
+    return _get_balances(user_id)[currency.upper()]
+
+# Load many users' rows with one query per 500 IDs, creating missing users (worker thread only)
+def _load_balances(user_ids):
+    rows = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        row = db.balance_cache.get(user_id)
+        if row is not None:
+            db.balance_cache_stats["hits"] += 1
+            rows[user_id] = row
+        else:
+            missing.append(user_id)
+
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        db.balance_cache_stats["misses"] += len(chunk)
+        db.c.execute(f"SELECT user_id, AP, SP, yen, reputation FROM users WHERE user_id IN ({','.join('?' * len(chunk))})", chunk)
+        for user_id, *result in db.c.fetchall():
+            rows[user_id] = dict(zip(CURRENCY_TYPES, result))
+        new_users = [(user_id,) for user_id in chunk if user_id not in rows]
+        db.c.executemany("INSERT INTO users (user_id, AP, SP, yen, reputation) VALUES (?, 0, 0, 0, 0)", new_users)
+        for (user_id,) in new_users:
+            rows[user_id] = dict.fromkeys(CURRENCY_TYPES, 0)
+
+    for user_id in missing:
+        db.balance_cache[user_id] = rows[user_id]
+        if len(db.balance_cache) > BALANCE_CACHE_SIZE:
+            db.balance_cache.popitem(last=False)
+    return rows
+
+# Add to a balance in SQL, keeping the cache in step (worker thread only)
+def _add_balance(user_id, currency, amount):
+    db.c.execute(f"UPDATE users SET {currency} = {currency} + ? WHERE user_id = ?", (amount, user_id))
+    row = db.balance_cache.get(user_id)
+    if row is not None:
+        row[currency.upper()] += amount
+
+# Keep the economy aggregates in step with a balance change: supply is the change in the
+# currency's total, deposited/spent add to today's volumes (worker thread only, caller commits)
+def _record_economy(currency, supply=0, deposited=0, spent=0):
+    currency = currency.upper()
+    if supply:
+        db.c.execute("UPDATE economy_totals SET supply = supply + ? WHERE currency = ?", (supply, currency))
+    if deposited or spent:
+        db.c.execute("""INSERT INTO economy_daily (day, currency, deposited, spent) VALUES (?, ?, ?, ?)
+                     ON CONFLICT (day, currency) DO UPDATE SET
+                         deposited = deposited + excluded.deposited,
+                         spent = spent + excluded.spent""",
+                  (now_ms() // 86_400_000, currency, deposited, spent))
+
+# Ledger primitives: relative, conditional updates so a balance is never computed in
+# Python and written back. Both create the user if needed and return the new balance.
+def _credit(user_id, currency, amount):
+    _get_balances(user_id)
+    _add_balance(user_id, currency, amount)
+    return _get_balance(user_id, currency)
+
+# Returns None (and changes nothing) if the balance is lower than amount
+def _debit(user_id, currency, amount):
+    _get_balances(user_id)
+    db.c.execute(f"UPDATE users SET {currency} = {currency} - ? WHERE user_id = ? AND {currency} >= ?", (amount, user_id, amount))
+    if db.c.rowcount == 0:
+        return None
+    row = db.balance_cache.get(user_id)
+    if row is not None:
+        row[currency.upper()] -= amount
+    return _get_balance(user_id, currency)
+
+# Striped per-account locks: commands touching the same account run one at a time,
+# commands on unrelated accounts only contend if they hash to the same stripe.
+ACCOUNT_LOCK_STRIPES = 64
+account_locks = [asyncio.Lock() for _ in range(ACCOUNT_LOCK_STRIPES)]
+
+@contextlib.asynccontextmanager
+async def lock_accounts(*user_ids):
+    # Always acquire in stripe order so two transfers in opposite directions can't deadlock
+    stripes = sorted({user_id % ACCOUNT_LOCK_STRIPES for user_id in user_ids})
+    async with contextlib.AsyncExitStack() as stack:
+        for stripe in stripes:
+            await stack.enter_async_context(account_locks[stripe])
+        yield
+
+# Transactions are timestamped in epoch milliseconds; local time is only rendered for display
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+def format_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp / 1000).strftime("%Y-%m-%d %H:%M:%S")
+
+# Function to store transaction history (worker thread only, caller commits)
+def _log_transaction(user_id, trans_type, amount, currency, reason=""):
+    timestamp = now_ms()
+    db.c.execute("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp) VALUES (?, ?, ?, ?, ?, ?)", 
               (user_id, trans_type, amount, currency, reason, timestamp))
-    conn.commit()
 
-
-# Function to embed stuff
-async def send_embed(ctx, title, description):
+# Store many (user_id, amount) ledger rows sharing a type, currency and reason (worker thread only, caller commits)
+def _log_transactions(entries, trans_type, currency, reason=""):
+    timestamp = now_ms()
+    db.c.executemany("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                  [(user_id, trans_type, amount, currency, reason, timestamp) for user_id, amount in entries])
+
+
+# Repository: each function below does its whole unit of work in one hop to the
+# guild's database thread. Commands must only touch the database through these,
+# passing ctx.guild.id as the first argument.
+
+# Balance reads never create the user; one without a row has nothing of anything
+async def get_balance(guild_id, user_id, currency):
+    def work():
+        row = _find_balances(user_id)
+        return row[currency.upper()] if row is not None else 0
+    return await run_db(guild_id, work)
+
+# Returns a copy of {currency: amount} for every currency
+async def get_balances(guild_id, user_id):
+    def work():
+        row = _find_balances(user_id)
+        return dict(row) if row is not None else dict.fromkeys(CURRENCY_TYPES, 0)
+    return await run_db(guild_id, work)
+
+def balance_cache_info():
+    info = {"size": 0, "max_size": 0, "hits": 0, "misses": 0}
+    for partition in partitions.values():
+        if partition.opened.done() and not partition.failed():
+            cache, stats = partition.opened.result()
+            info["size"] += len(cache)
+            info["max_size"] += BALANCE_CACHE_SIZE
+            info["hits"] += stats["hits"]
+            info["misses"] += stats["misses"]
+    return info
+
+# Loads the balances of the most recently active users into the cache, so their first
+# command after a restart is a hit. Only rows that already exist are read; no users are
+# created. Returns the number of rows loaded.
+async def warm_balance_cache(guild_id, limit=BALANCE_CACHE_SIZE):
+    def work():
+        db.c.execute("""SELECT user_id, AP, SP, yen, reputation FROM users WHERE user_id IN (
+                            SELECT DISTINCT user_id FROM (SELECT user_id FROM transactions ORDER BY id DESC LIMIT ?)
+                        ) LIMIT ?""", (limit * 2, limit))
+        loaded = 0
+        for user_id, *result in db.c.fetchall():
+            if user_id not in db.balance_cache:
+                db.balance_cache[user_id] = dict(zip(CURRENCY_TYPES, result))
+                db.balance_cache.move_to_end(user_id, last=False)
+                loaded += 1
+        while len(db.balance_cache) > BALANCE_CACHE_SIZE:
+            db.balance_cache.popitem(last=False)
+        return loaded
+    return await run_db(guild_id, work)
+
+# Page readers below take a keyset cursor (taken from the last row already shown,
+# or None for the first page) and return at most limit rows after it. They run on the
+# guild's reader connections (run_read).
+
+# Newest first: (id, type, amount, currency, reason, timestamp). The cursor is (timestamp, id);
+# since/until are optional epoch-millisecond bounds (until is exclusive). With include_archive
+# archived rows are merged in; UNION also drops any row an interrupted !archive left in both.
+async def get_history_page(guild_id, user_id, cursor, limit, since=None, until=None, include_archive=False):
+    def work():
+        where = "user_id=?"
+        params = [user_id]
+        if since is not None:
+            where += " AND timestamp>=?"
+            params.append(since)
+        if until is not None:
+            where += " AND timestamp<?"
+            params.append(until)
+        if cursor is not None:
+            where += " AND (timestamp, id) < (?, ?)"
+            params.extend(cursor)
+        query = f"SELECT id, type, amount, currency, reason, timestamp FROM main.transactions WHERE {where}"
+        if include_archive:
+            query += f" UNION SELECT id, type, amount, currency, reason, timestamp FROM archive.transactions WHERE {where}"
+            params *= 2
+        db.c.execute(query + " ORDER BY timestamp DESC, id DESC LIMIT ?", (*params, limit))
+        return db.c.fetchall()
+    return await run_read(guild_id, work)
+
+# Number of a user's transactions that have been archived
+async def get_archived_count(guild_id, user_id):
+    def work():
+        # Counted in the archive itself (a range of its user index): transaction_summaries
+        # also holds folded payout credits, which --archive yes has no rows to show for
+        db.c.execute("SELECT COUNT(*) FROM archive.transactions WHERE user_id=?", (user_id,))
+        return db.c.fetchone()[0]
+    return await run_read(guild_id, work)
+
+async def add_pending_deposits(guild_id, user_id, deposits, reason):
+    def work():
+        timestamp = now_ms()
+        db.c.executemany("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      [(user_id, "deposit", amount, currency, reason, timestamp, "PENDING") for currency, amount in deposits])
+    await run_write(guild_id, work)
+
+# Returns (spent, balance). balance is the new balance, or the current one if it was too low.
+async def spend_currency(guild_id, user_id, currency, amount, reason):
+    def work():
+        new_balance = _debit(user_id, currency, amount)
+        if new_balance is None:
+            return False, _get_balance(user_id, currency)
+        _log_transaction(user_id, "spend", amount, currency, reason)
+        _record_economy(currency, supply=-amount, spent=amount)
+        return True, new_balance
+    async with lock_accounts(user_id):
+        return await run_write(guild_id, work)
+
+# Returns (transferred, sender_balance, receiver_balance)
+async def transfer_yen(guild_id, sender_id, receiver_id, amount, sender_name, receiver_name):
+    def work():
+        new_sender_balance = _debit(sender_id, "yen", amount)
+        if new_sender_balance is None:
+            return False, _get_balance(sender_id, "yen"), None
+        receiver_balance = _credit(receiver_id, "yen", amount)
+        _log_transaction(sender_id, "transfer_out", amount, "yen", f"Sent to {receiver_name}")
+        _log_transaction(receiver_id, "transfer_in", amount, "yen", f"Received from {sender_name}")
+        return True, new_sender_balance, receiver_balance
+    async with lock_accounts(sender_id, receiver_id):
+        return await run_write(guild_id, work)
+
+# Adds amount to a single user's balance and returns the new balance
+async def give_currency(guild_id, user_id, currency, amount, trans_type, reason):
+    def work():
+        new_balance = _credit(user_id, currency, amount)
+        _log_transaction(user_id, trans_type, amount, currency, reason)
+        _record_economy(currency, supply=amount)
+        return new_balance
+    async with lock_accounts(user_id):
+        return await run_write(guild_id, work)
+
+# Gives amount to every user in one transaction. Returns the number of users paid.
+async def give_all(guild_id, currency, amount, reason):
+    def work():
+        db.c.execute("UPDATE users SET {} = {} + ?".format(currency, currency), (amount,))
+        paid = db.c.rowcount
+        # Every cached row is an existing user, so all of them got the bonus
+        for row in db.balance_cache.values():
+            row[currency] += amount
+        timestamp = now_ms()
+        db.c.execute("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp) "
+                  "SELECT user_id, 'admin_giveall', ?, ?, ?, ? FROM users", (amount, currency, reason, timestamp))
+        _record_economy(currency, supply=amount * paid)
+        return paid
+    return await run_write(guild_id, work)
+
+# Gives amount to each listed user (repeats count twice) in one transaction
+async def give_many(guild_id, user_ids, currency, amount, reason):
+    def work():
+        rows = _load_balances(user_ids)
+        db.c.executemany(f"UPDATE users SET {currency} = {currency} + ? WHERE user_id = ?", [(amount, user_id) for user_id in user_ids])
+        for user_id in user_ids:
+            rows[user_id][currency] += amount
+        _log_transactions([(user_id, amount) for user_id in user_ids], "admin_multi_give", currency, reason)
+        _record_economy(currency, supply=amount * len(user_ids))
+    await run_write(guild_id, work)
+
+# Removes amount from each listed user in one transaction, clamping at 0.
+# Returns [(user_id, old_balance, new_balance)]; users already at 0 are left untouched.
+async def remove_many(guild_id, user_ids, currency, amount, reason):
+    def work():
+        rows = _load_balances(user_ids)
+        results = []
+        for user_id in user_ids:
+            row = rows[user_id]
+            current_balance = row[currency.upper()]
+            if current_balance == 0:
+                results.append((user_id, 0, 0))
+                continue
+            row[currency.upper()] = max(0, current_balance - amount)
+            results.append((user_id, current_balance, row[currency.upper()]))
+
+        changed = [(user_id, old, new) for user_id, old, new in results if old != 0]
+        db.c.executemany(f"UPDATE users SET {currency}=? WHERE user_id=?", [(new, user_id) for user_id, old, new in changed])
+        # Log what was actually removed, which is less than amount when the balance hit 0
+        _log_transactions([(user_id, new - old) for user_id, old, new in changed], "admin_remove", currency, reason)
+        _record_economy(currency, supply=sum(new - old for user_id, old, new in changed))
+        return results
+    return await run_write(guild_id, work)
+
+# Sets pending deposits to APPROVED/DENIED in one transaction, crediting approved amounts
+# with one UPDATE per (user, currency). Returns one entry per ID, in order:
+# (user_id, amount, currency, new_balance), or None if that ID was not pending.
+async def settle_deposits(guild_id, transaction_ids, approve):
+    def work():
+        unique_ids = list(dict.fromkeys(transaction_ids))
+        pending = {}
+        for i in range(0, len(unique_ids), 500):
+            chunk = unique_ids[i:i + 500]
+            db.c.execute(f"SELECT id, user_id, amount, currency FROM transactions WHERE status='PENDING' AND id IN ({','.join('?' * len(chunk))})", chunk)
+            for transaction_id, user_id, amount, currency in db.c.fetchall():
+                pending[transaction_id] = (user_id, amount, currency.upper())
+        if not pending:
+            return [None] * len(transaction_ids)
+
+        status = "APPROVED" if approve else "DENIED"
+        db.c.executemany("UPDATE transactions SET status=? WHERE id=?", [(status, transaction_id) for transaction_id in pending])
+
+        rows = _load_balances([user_id for user_id, amount, currency in pending.values()]) if approve else {}
+        deltas = {}
+        results = []
+        settled = set()
+        for transaction_id in transaction_ids:
+            # A repeated ID is only settled the first time, like a second command would be
+            if transaction_id not in pending or transaction_id in settled:
+                results.append(None)
+                continue
+            settled.add(transaction_id)
+            user_id, amount, currency = pending[transaction_id]
+            new_balance = None
+            if approve:
+                deltas[user_id, currency] = deltas.get((user_id, currency), 0) + amount
+                new_balance = rows[user_id][currency] + deltas[user_id, currency]
+            results.append((user_id, amount, currency, new_balance))
+
+        totals = {}
+        for (user_id, currency), delta in deltas.items():
+            _add_balance(user_id, currency, delta)
+            totals[currency] = totals.get(currency, 0) + delta
+        for currency, total in totals.items():
+            _record_economy(currency, supply=total, deposited=total)
+        return results
+    return await run_write(guild_id, work)
+
+# Moves settled transactions older than cutoff (epoch ms) into the archive database and
+# folds them into transaction_summaries. Returns the number of rows moved.
+async def archive_transactions(guild_id, cutoff):
+    settled = "timestamp < ? AND (status IS NULL OR status != 'PENDING')"
+
+    # A transaction spanning two WAL databases is not atomic across them, so the move is two
+    # units of work: the copy is committed to the archive before anything leaves main
+    def copy():
+        # OR IGNORE: rows copied by an earlier run that was interrupted before its delete
+        db.c.execute(f"INSERT OR IGNORE INTO archive.transactions SELECT id, user_id, type, amount, currency, reason, timestamp, status "
+                  f"FROM main.transactions WHERE {settled}", (cutoff,))
+
+    def work():
+        # Only rows already safely in the archive are summarized and deleted
+        settled_archived = f"{settled} AND id IN (SELECT id FROM archive.transactions)"
+        # Payout summary rows (no user_id) are archived but have nothing to summarize per user
+        db.c.execute(f"""INSERT INTO transaction_summaries (user_id, currency, type, status, total, count, archived_through)
+                      SELECT user_id, UPPER(currency), type, COALESCE(status, ''), SUM(amount), COUNT(*), MAX(timestamp)
+                      FROM main.transactions WHERE {settled_archived} AND user_id IS NOT NULL
+                      GROUP BY user_id, UPPER(currency), type, COALESCE(status, '')
+                      ON CONFLICT (user_id, currency, type, status) DO UPDATE SET
+                          total = total + excluded.total,
+                          count = count + excluded.count,
+                          archived_through = MAX(archived_through, excluded.archived_through)""", (cutoff,))
+        db.c.execute(f"DELETE FROM main.transactions WHERE {settled_archived}", (cutoff,))
+        moved = db.c.rowcount
+        # Old payout credits are folded into the summaries too (as PAYOUT_CREDIT_TYPE), but only
+        # those of runs the latest snapshot already includes, which is all a snapshot-based
+        # reconciliation replays
+        credits = """FROM payout_runs r CROSS JOIN payout_credits c ON c.run_id = r.id
+                     WHERE r.ran_at < ? AND r.ledger_id <= (SELECT COALESCE(MAX(through_id), 0) FROM balance_snapshots)"""
+        db.c.execute(f"""INSERT INTO transaction_summaries (user_id, currency, type, status, total, count, archived_through)
+                      SELECT c.user_id, r.currency, ?, '', SUM(c.amount), COUNT(*), MAX(r.ran_at) {credits}
+                      GROUP BY c.user_id, r.currency
+                      ON CONFLICT (user_id, currency, type, status) DO UPDATE SET
+                          total = total + excluded.total,
+                          count = count + excluded.count,
+                          archived_through = MAX(archived_through, excluded.archived_through)""",
+                     (ledger.PAYOUT_CREDIT_TYPE, cutoff))
+        db.c.execute(f"DELETE FROM payout_credits WHERE run_id IN (SELECT r.id FROM payout_runs r WHERE r.ran_at < ? "
+                     f"AND r.ledger_id <= (SELECT COALESCE(MAX(through_id), 0) FROM balance_snapshots))", (cutoff,))
+        return moved
+    await run_write(guild_id, copy)
+    return await run_write(guild_id, work)
+
+# Record the current balances as a new snapshot, dropping all but the newest SNAPSHOTS_KEPT.
+# Returns the snapshot ID. (worker thread only, caller commits)
+def _take_snapshot():
+    # The highest ID ever handed out, even if that row has since been archived
+    db.c.execute("SELECT COALESCE((SELECT seq FROM main.sqlite_sequence WHERE name='transactions'), 0)")
+    through_id = db.c.fetchone()[0]
+    db.c.execute("INSERT INTO balance_snapshots (taken_at, through_id) VALUES (?, ?)", (now_ms(), through_id))
+    snapshot_id = db.c.lastrowid
+    db.c.execute("INSERT INTO snapshot_balances (snapshot_id, user_id, AP, SP, yen, reputation) "
+              "SELECT ?, user_id, AP, SP, yen, reputation FROM users", (snapshot_id,))
+    db.c.execute("INSERT INTO snapshot_pending (snapshot_id, transaction_id) "
+              "SELECT ?, id FROM transactions WHERE status='PENDING'", (snapshot_id,))
+    for table, column in (("snapshot_balances", "snapshot_id"), ("snapshot_pending", "snapshot_id"), ("balance_snapshots", "id")):
+        db.c.execute(f"DELETE FROM {table} WHERE {column} <= ?", (snapshot_id - SNAPSHOTS_KEPT,))
+    return snapshot_id
+
+# Logs a 'reconcile_adjust' row for each drifted (user_id, currency, expected, actual) so the
+# ledger matches the balances again, then takes a new snapshot. Returns the snapshot ID.
+async def record_reconciliation(guild_id, drift):
+    def work():
+        by_currency = {}
+        for user_id, currency, expected, actual in drift:
+            by_currency.setdefault(currency, []).append((user_id, actual - expected))
+        for currency, entries in by_currency.items():
+            _log_transactions(entries, "reconcile_adjust", currency, "Reconciliation adjustment")
+        return _take_snapshot()
+    return await run_write(guild_id, work)
+
+# Rebuild the main database file so the space freed by archiving is returned. VACUUM
+# cannot run inside a transaction, so whatever the group committer has open is committed first.
+async def compact_database(guild_id):
+    def work():
+        _commit_open()
+        db.c.execute("VACUUM main")
+    await run_db(guild_id, work)
+
+# The limit users with the highest balance in currency: [(user_id, amount)]. Reads the top of
+# the currency's index, so the cost doesn't depend on how many users there are.
+async def get_leaderboard(guild_id, currency, limit):
+    def work():
+        db.c.execute(f"SELECT user_id, {currency} FROM users ORDER BY {currency} DESC, user_id LIMIT ?", (limit,))
+        return db.c.fetchall()
+    return await run_db(guild_id, work)
+
+# {currency: (supply, deposited, spent)}, the volumes summed over the last days UTC days
+async def get_economy(guild_id, days):
+    def work():
+        db.c.execute("SELECT currency, supply FROM economy_totals")
+        economy = {currency: (supply, 0, 0) for currency, supply in db.c.fetchall()}
+        db.c.execute("SELECT currency, SUM(deposited), SUM(spent) FROM economy_daily WHERE day > ? GROUP BY currency",
+                  (now_ms() // 86_400_000 - days,))
+        for currency, deposited, spent in db.c.fetchall():
+            economy[currency] = (economy.get(currency, (0,))[0], deposited, spent)
+        return economy
+    return await run_db(guild_id, work)
+
+# (id, user_id, amount, currency, reason, timestamp)
+async def get_pending_page(guild_id, after_id, limit):
+    def work():
+        db.c.execute("SELECT id, user_id, amount, currency, reason, timestamp FROM transactions WHERE status='PENDING' AND id>? ORDER BY id LIMIT ?", (after_id or 0, limit))
+        return db.c.fetchall()
+    return await run_read(guild_id, work)
+
+# (user_id, AP, SP, yen, reputation)
+async def get_balances_page(guild_id, after_user_id, limit):
+    def work():
+        if after_user_id is None:
+            db.c.execute("SELECT user_id, AP, SP, yen, reputation FROM users ORDER BY user_id LIMIT ?", (limit,))
+        else:
+            db.c.execute("SELECT user_id, AP, SP, yen, reputation FROM users WHERE user_id>? ORDER BY user_id LIMIT ?", (after_user_id, limit))
+        return db.c.fetchall()
+    return await run_read(guild_id, work)
+
+# Credits every unapproved deposit a user made for the given reason. Returns the credited rows.
+async def approve_user_deposits(guild_id, user_id, reason):
+    def work():
+        db.c.execute("SELECT currency, amount FROM transactions WHERE user_id=? AND reason=? AND type='deposit' AND status IS NULL", (user_id, reason))
+        rows = db.c.fetchall()
+        if not rows:
+            return rows
+        for currency, amount in rows:
+            _credit(user_id, currency, amount)
+            _record_economy(currency, supply=amount, deposited=amount)
+        # Only the rows just credited; settled deposits with the same reason keep their status
+        db.c.execute("UPDATE transactions SET status='approved' WHERE user_id=? AND reason=? AND type='deposit' AND status IS NULL", (user_id, reason))
+        return rows
+    return await run_write(guild_id, work)
+
+async def reject_user_deposits(guild_id, user_id, reason):
+    def work():
+        db.c.execute("UPDATE transactions SET status='rejected' WHERE user_id=? AND reason=? AND type='deposit' AND status IS NULL", (user_id, reason))
+    await run_write(guild_id, work)
+
+# Scheduled payouts. Schedule rows are
+# (id, kind, currency, amount, role_id, interval_ms, next_run, reason, last_ran_at, last_users, last_total).
+PAYOUT_COLUMNS = """s.id, s.kind, s.currency, s.amount, s.role_id, s.interval_ms, s.next_run, s.reason,
+                    r.ran_at, r.users, r.total
+                    FROM payout_schedules s LEFT JOIN payout_runs r
+                    ON r.id = (SELECT MAX(id) FROM payout_runs WHERE schedule_id = s.id)"""
+
+async def add_payout_schedule(guild_id, kind, currency, amount, role_id, interval_ms, first_run, reason, created_by):
+    def work():
+        db.c.execute("INSERT INTO payout_schedules (kind, currency, amount, role_id, interval_ms, next_run, reason, created_by) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (kind, currency, amount, role_id, interval_ms, first_run, reason, created_by))
+        return db.c.lastrowid
+    return await run_write(guild_id, work)
+
+async def get_payout_schedules(guild_id):
+    def work():
+        db.c.execute(f"SELECT {PAYOUT_COLUMNS} WHERE s.active = 1 ORDER BY s.id")
+        return db.c.fetchall()
+    return await run_db(guild_id, work)
+
+# Stops a schedule; returns False if there is no such active schedule
+async def remove_payout_schedule(guild_id, schedule_id):
+    def work():
+        db.c.execute("UPDATE payout_schedules SET active = 0 WHERE id = ? AND active = 1", (schedule_id,))
+        return db.c.rowcount > 0
+    return await run_write(guild_id, work)
+
+# When the next run of any schedule is due (epoch ms), or None without schedules
+async def next_payout_due(guild_id):
+    def work():
+        db.c.execute("SELECT MIN(next_run) FROM payout_schedules WHERE active = 1")
+        return db.c.fetchone()[0]
+    return await run_db(guild_id, work)
+
+async def get_due_payouts(guild_id, now):
+    def work():
+        db.c.execute(f"SELECT {PAYOUT_COLUMNS} WHERE s.active = 1 AND s.next_run <= ? ORDER BY s.next_run", (now,))
+        return db.c.fetchall()
+    return await run_db(guild_id, work)
+
+# Applies the run of a schedule that was due at due_at as one set-based unit of work: every
+# user's credit goes into payout_credits, the balances are updated from it in one statement
+# and one summary row is logged, and next_run moves on by one interval. member_ids is the
+# role's members, or None to pay every user. Returns (users, total), or None if that run
+# had already been applied or the schedule was removed.
+async def run_payout(guild_id, schedule, due_at, member_ids):
+    schedule_id, kind, currency, amount, role_id, interval_ms, next_run, reason = schedule[:8]
+    column = CURRENCY_COLUMNS[currency]
+
+    def work():
+        db.c.execute("UPDATE payout_schedules SET next_run = ? WHERE id = ? AND next_run = ? AND active = 1",
+                     (due_at + interval_ms, schedule_id, due_at))
+        if db.c.rowcount == 0:
+            return None
+        ran_at = now_ms()
+        db.c.execute("INSERT INTO payout_runs (schedule_id, due_at, ran_at, currency) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (schedule_id, due_at) DO NOTHING", (schedule_id, due_at, ran_at, currency))
+        if db.c.rowcount == 0:
+            return None
+        run_id = db.c.lastrowid
+
+        cohort = "users"
+        if member_ids is not None:
+            db.c.execute("CREATE TEMP TABLE IF NOT EXISTS payout_members (user_id INTEGER PRIMARY KEY)")
+            db.c.execute("DELETE FROM temp.payout_members")
+            db.c.executemany("INSERT OR IGNORE INTO temp.payout_members VALUES (?)", [(user_id,) for user_id in member_ids])
+            cohort = "users WHERE user_id IN (SELECT user_id FROM temp.payout_members)"
+            if kind == "payout":
+                # Members who have never used the bank get an account, as with !multi_give
+                db.c.execute("INSERT OR IGNORE INTO users (user_id) SELECT user_id FROM temp.payout_members")
+        if kind == "payout":
+            db.c.execute(f"INSERT INTO payout_credits (run_id, user_id, amount) SELECT ?, user_id, ? FROM {cohort}", (run_id, amount))
+        else:
+            # Basis points of positive balances, rounded toward zero
+            db.c.execute(f"INSERT INTO payout_credits (run_id, user_id, amount) "
+                         f"SELECT ?, user_id, {column} * ? / 10000 FROM {cohort} "
+                         f"{'AND' if member_ids is not None else 'WHERE'} {column} * ? / 10000 != 0 AND {column} > 0",
+                         (run_id, amount, amount))
+        db.c.execute(f"UPDATE users SET {column} = users.{column} + c.amount FROM payout_credits c "
+                     f"WHERE c.run_id = ? AND users.user_id = c.user_id", (run_id,))
+        db.c.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM payout_credits WHERE run_id = ?", (run_id,))
+        users, total = db.c.fetchone()
+
+        db.c.execute("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp) VALUES (NULL, ?, ?, ?, ?, ?)",
+                     (f"scheduled_{kind}", total, currency, f"{reason} (schedule #{schedule_id}, {users:,} users)", ran_at))
+        db.c.execute("UPDATE payout_runs SET ledger_id = ?, users = ?, total = ? WHERE id = ?", (db.c.lastrowid, users, total, run_id))
+        _record_economy(currency, supply=total)
+
+        if kind == "payout" and member_ids is None:
+            # Every cached row is an existing user, so all of them were paid
+            for row in db.balance_cache.values():
+                row[currency] += amount
+        else:
+            db.balance_cache.clear()
+        return users, total
+    return await run_write(guild_id, work)
+
+# Writes one table of a guild's bank to a gzipped CSV or JSONL file (see bulk.py). It reads
+# through its own read-only connection off the worker thread, so commands carry on meanwhile.
+async def export_table(guild_id, table, fmt, path):
+    partition = get_partition(guild_id)
+    # Make sure the file exists and is migrated before another connection reads it
+    await asyncio.wrap_future(partition.opened)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, bulk.export_table, partition.path, partition.archive_path, table, fmt, path)
+
+# Staging tables for bulk imports, on the worker connection's temp database
+IMPORT_STAGING = {
+    "users": "user_id INTEGER PRIMARY KEY, AP INTEGER, SP INTEGER, yen INTEGER, reputation INTEGER",
+    "transactions": "user_id INTEGER, type TEXT, amount INTEGER, currency TEXT, reason TEXT, timestamp INTEGER, status TEXT",
+}
+import_lock = asyncio.Lock()
+
+# Bulk import steps (worker thread only, run as units of work by import_table)
+def _begin_import(table):
+    db.c.execute(f"DROP TABLE IF EXISTS temp.import_{table}")
+    db.c.execute(f"CREATE TEMP TABLE import_{table} ({IMPORT_STAGING[table]})")
+
+# Stages the next chunk of records; returns how many, 0 once the file is exhausted
+def _stage_import(table, chunks):
+    chunk = next(chunks, None)
+    if chunk is None:
+        return 0
+    # A user listed twice keeps their last row
+    verb = "INSERT OR REPLACE" if table == "users" else "INSERT"
+    db.c.executemany(f"{verb} INTO temp.import_{table} VALUES ({','.join('?' * len(chunk[0]))})", chunk)
+    return len(chunk)
+
+def _apply_import(table, reason):
+    cache_size = db.c.execute("PRAGMA cache_size").fetchone()[0]
+    db.c.execute(f"PRAGMA cache_size = -{IMPORT_CACHE_KIB}")
+    try:
+        _apply_changes(table, reason)
+    finally:
+        db.c.execute(f"PRAGMA cache_size = {cache_size}")
+    # Simpler than patching every cached row the import touched
+    db.balance_cache.clear()
+
+def _apply_changes(table, reason):
+    columns = CURRENCY_COLUMNS
+    # Per-user change of each balance, worked out in one pass over the staged rows
+    if table == "users":
+        # Balances are set to the file's values
+        db.c.execute(f"""CREATE TEMP TABLE import_changes AS
+                         SELECT s.user_id, {', '.join(f's.{column} - COALESCE(u.{column}, 0) AS {column}' for column in columns.values())}
+                         FROM temp.import_users s LEFT JOIN users u ON u.user_id = s.user_id""")
+    else:
+        # Rows are appended to the ledger in file order and their effect applied to the balances
+        db.c.execute("""INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp, status)
+                     SELECT user_id, type, amount, currency, reason, timestamp, status
+                     FROM temp.import_transactions ORDER BY rowid""")
+        db.c.execute(f"""CREATE TEMP TABLE import_changes AS
+                         SELECT user_id, {', '.join(f"SUM(CASE WHEN UPPER(currency) = '{currency}' THEN {reconciliation.LEDGER_EFFECT} ELSE 0 END) AS {column}" for currency, column in columns.items())}
+                         FROM temp.import_transactions GROUP BY user_id""")
+        # Daily volumes of the imported history, the way migration 6 backfilled them
+        db.c.execute("""INSERT INTO economy_daily (day, currency, deposited, spent)
+                     SELECT timestamp / 86400000, UPPER(currency),
+                            SUM(CASE WHEN type = 'deposit' THEN amount ELSE 0 END),
+                            SUM(CASE WHEN type = 'spend' THEN amount ELSE 0 END)
+                     FROM temp.import_transactions
+                     WHERE type = 'spend' OR (type = 'deposit' AND UPPER(status) = 'APPROVED')
+                     GROUP BY timestamp / 86400000, UPPER(currency)
+                     ON CONFLICT (day, currency) DO UPDATE SET
+                         deposited = deposited + excluded.deposited,
+                         spent = spent + excluded.spent""")
+
+    db.c.execute(f"SELECT {', '.join(f'COALESCE(SUM({column}), 0)' for column in columns.values())} FROM temp.import_changes")
+    for currency, supply in zip(columns, db.c.fetchone()):
+        _record_economy(currency, supply=supply)
+    if table == "users":
+        # Each change is logged as an 'import' row, so the ledger still adds up to the balances
+        timestamp = now_ms()
+        for currency, column in columns.items():
+            db.c.execute(f"INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp) "
+                         f"SELECT user_id, 'import', {column}, ?, ?, ? FROM temp.import_changes WHERE {column} != 0",
+                         (currency, reason, timestamp))
+    # New users are inserted with their balances; existing ones only updated if something changed
+    db.c.execute(f"""INSERT INTO users (user_id, AP, SP, yen, reputation)
+                     SELECT user_id, AP, SP, yen, reputation FROM temp.import_changes WHERE true
+                     ON CONFLICT (user_id) DO UPDATE SET
+                         {', '.join(f'{column} = {column} + excluded.{column}' for column in columns.values())}
+                     WHERE {' OR '.join(f'excluded.{column} != 0' for column in columns.values())}""")
+    db.c.execute("DROP TABLE temp.import_changes")
+    db.c.execute(f"DROP TABLE temp.import_{table}")
+
+# Streams a CSV or JSONL file (optionally gzipped) into a guild's users or transactions,
+# IMPORT_CHUNK_SIZE records at a time. Importing users sets their balances; importing
+# transactions appends them to the ledger and applies them to the balances. Nothing is
+# applied unless the whole file is valid. Returns the number of records read.
+async def import_table(guild_id, table, fmt, path, reason):
+    async with import_lock:
+        partition = get_partition(guild_id)
+        # Counted as in flight throughout, so the staging table isn't closed with the partition
+        partition.in_flight += 1
+        # Only ever advanced on the worker thread, one chunk per unit of work
+        chunks = bulk.chunked(bulk.read_rows(path, table, fmt), IMPORT_CHUNK_SIZE)
+        try:
+            await run_write(guild_id, _begin_import, table)
+            records = 0
+            while True:
+                staged = await run_write(guild_id, _stage_import, table, chunks)
+                if not staged:
+                    break
+                records += staged
+            await run_write(guild_id, _apply_import, table, reason)
+        finally:
+            chunks.close()
+            partition.in_flight -= 1
+        return records
+
+
+# Outbound messages. send_embed only queues the embed and returns; one task per channel
+# sends the queue, pacing itself to the channel's rate limit. Embeds that pile up while
+# it waits go out together as fields of one message, so a burst costs one request.
+CHANNEL_RATE_LIMIT = 5  # messages per CHANNEL_RATE_PERIOD seconds, Discord's per-channel bucket
+CHANNEL_RATE_PERIOD = 5.0
+MAX_EMBED_FIELDS = 25
+MAX_EMBED_CHARS = 5500  # Discord allows 6000 characters per embed; leave room for the title
+MAX_EMBED_DESCRIPTION = 4096
+
+class ChannelOutbox:
+    def __init__(self):
+        self.pending = deque()  # (ctx, title, description)
+        self.sent_at = deque()  # send times inside the current rate-limit window
+        self.task = None
+
+    async def wait_for_slot(self):
+        now = time.monotonic()
+        while self.sent_at and self.sent_at[0] + CHANNEL_RATE_PERIOD <= now:
+            self.sent_at.popleft()
+        if len(self.sent_at) >= CHANNEL_RATE_LIMIT:
+            await asyncio.sleep(self.sent_at[0] + CHANNEL_RATE_PERIOD - now)
+            self.sent_at.popleft()
+
+    # Take as many queued embeds as fit in one message
+    def take_batch(self):
+        ctx, title, description = self.pending.popleft()
+        batch = [(title, description)]
+        if len(description) > 1024:
+            return ctx, batch
+        size = len(title) + len(description)
+        while self.pending and len(batch) < MAX_EMBED_FIELDS:
+            next_ctx, title, description = self.pending[0]
+            if len(description) > 1024 or size + len(title) + len(description) > MAX_EMBED_CHARS:
+                break
+            self.pending.popleft()
+            batch.append((title, description))
+            size += len(title) + len(description)
+        return ctx, batch
+
+channel_outboxes = {}
+dm_queue = asyncio.Queue()
+dm_task = None
+
+def build_embed(fields):
     embed = discord.Embed(title="Tokyo Banking", color=0xce2222)
     embed.set_thumbnail(url="")
-    embed.add_field(name=title, value=description, inline=False)
-    await ctx.send(embed=embed)
-
-
+    if len(fields) == 1 and len(fields[0][1]) > 1024:
+        # Field values are capped at 1024 characters; the description allows 4096
+        # (send_embed splits longer text into several embeds)
+        title, description = fields[0]
+        embed.description = f"**{title}**\n{description}"
+        return embed
+    for title, description in fields:
+        embed.add_field(name=title, value=description, inline=False)
+    return embed
+
+async def _drain_outbox(outbox):
+    try:
+        while outbox.pending:
+            await outbox.wait_for_slot()
+            ctx, fields = outbox.take_batch()
+            started = time.perf_counter()
+            try:
+                await ctx.send(embed=build_embed(fields))
+            except Exception as error:
+                # HTTP errors, but also dropped connections and timeouts; the next message still goes out
+                print(f"Failed to send message: {error}")
+            outbox.sent_at.append(time.monotonic())
+            observe("send", "channel_message", time.perf_counter() - started)
+    finally:
+        outbox.task = None
+
+# Splits text into parts of at most size characters, at line breaks where possible
+def split_text(text, size):
+    parts = []
+    while len(text) > size:
+        cut = text.rfind("\n", 0, size + 1)
+        if cut <= 0:
+            cut = size
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+# Function to embed stuff. Text too long for one embed is sent as several.
+async def send_embed(ctx, title, description):
+    outbox = channel_outboxes.get(ctx.channel.id)
+    if outbox is None:
+        outbox = channel_outboxes[ctx.channel.id] = ChannelOutbox()
+    # Room left in an embed description after the bold title line
+    size = MAX_EMBED_DESCRIPTION - len(f"**{title} (continued)**\n")
+    for number, part in enumerate(split_text(description, size)):
+        outbox.pending.append((ctx, title if number == 0 else f"{title} (continued)", part))
+    if outbox.task is None:
+        outbox.task = asyncio.create_task(_drain_outbox(outbox))
+
+async def _dm_worker(client):
+    global dm_task
+    try:
+        while True:
+            user_id, text = await dm_queue.get()
+            started = time.perf_counter()
+            try:
+                user = client.get_user(user_id) or await client.fetch_user(user_id)
+                await user.send(text)
+            except Exception as error:
+                # Unknown user, DMs closed or a network error; the channel reply already went out
+                print(f"Failed to DM {user_id}: {error}")
+            finally:
+                dm_queue.task_done()
+            observe("send", "direct_message", time.perf_counter() - started)
+    finally:
+        # Started again by the next send_dm
+        dm_task = None
+
+# Queue a direct message; a background worker resolves the user through client and sends it
+async def send_dm(client, user_id, text):
+    global dm_task
+    dm_queue.put_nowait((user_id, text))
+    if dm_task is None:
+        dm_task = asyncio.create_task(_dm_worker(client))
+
+# Wait until every queued channel message and DM has been sent
+async def flush_outbound():
+    for outbox in list(channel_outboxes.values()):
+        if outbox.task is not None:
+            await outbox.task
+    await dm_queue.join()
+
+# Member names and mentions for rendering, cached per guild for MEMBER_CACHE_TTL seconds.
+# Misses are looked up in the gateway member cache, then fetched in chunked gateway
+# requests; users who have left the server are cached too, with a fallback name.
+MEMBER_CACHE_SIZE = 5000
+MEMBER_CACHE_TTL = 600
+MEMBER_QUERY_CHUNK = 100  # the gateway accepts at most 100 IDs per member request
+member_cache = OrderedDict()  # (guild_id, user_id) -> (expires_at, name, mention)
+
+def _cache_member(guild_id, user_id, name, mention):
+    member_cache[guild_id, user_id] = (time.monotonic() + MEMBER_CACHE_TTL, name, mention)
+    member_cache.move_to_end((guild_id, user_id))
+    if len(member_cache) > MEMBER_CACHE_SIZE:
+        member_cache.popitem(last=False)
+
+# Returns {user_id: (name, mention)} for every ID, without any per-ID network calls
+async def resolve_members(guild, user_ids):
+    now = time.monotonic()
+    resolved = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        entry = member_cache.get((guild.id, user_id))
+        if entry is not None and entry[0] > now:
+            resolved[user_id] = entry[1:]
+            continue
+        member = guild.get_member(user_id)
+        if member is not None:
+            _cache_member(guild.id, user_id, member.name, member.mention)
+            resolved[user_id] = (member.name, member.mention)
+        else:
+            missing.append(user_id)
 
-@bot.command()
-async def usercommands(ctx):
-    help_text = """
+    for i in range(0, len(missing), MEMBER_QUERY_CHUNK):
+        chunk = missing[i:i + MEMBER_QUERY_CHUNK]
+        try:
+            members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+        except (asyncio.TimeoutError, discord.ClientException) as error:
+            print(f"Member lookup failed: {error}")
+            members = []
+        for member in members:
+            _cache_member(guild.id, member.id, member.name, member.mention)
+            resolved[member.id] = (member.name, member.mention)
+        for user_id in chunk:
+            if user_id not in resolved:
+                # No longer in the server; a raw mention still renders
+                _cache_member(guild.id, user_id, f"Unknown user ({user_id})", f"<@{user_id}>")
+                resolved[user_id] = member_cache[guild.id, user_id][1:]
+    return resolved
+
+# Long listings are shown one page at a time with Previous/Next buttons. Each page is
+# pulled with a keyset cursor, so only the rows on screen are ever held in memory.
+PAGE_SIZE = 10
+
+class Pager(discord.ui.View):
+    def __init__(self, author_id, title, header, fetch_page, render_row, limit=None, cursor=None):
+        super().__init__(timeout=300)
+        self.author_id = author_id
+        self.title = title
+        self.header = header
+        self.fetch_page = fetch_page
+        self.render_row = render_row
+        self.limit = limit
+        # Keyset cursor of a row; defaults to its first column
+        self.cursor = cursor or (lambda row: row[0])
+        # cursors[n] is the keyset cursor page n starts after
+        self.cursors = [None]
+        self.page = 0
+        self.rows = []
+
+    # Fetch the current page (plus one row to see if there is another) and update the buttons
+    async def load(self):
+        size = PAGE_SIZE
+        # The last page the limit allows has no Next, so there is no extra row to fetch
+        last_page = self.limit is not None and (self.page + 1) * PAGE_SIZE >= self.limit
+        if self.limit is not None:
+            size = min(size, self.limit - self.page * PAGE_SIZE)
+        # Never fetch with a size <= 0: SQLite reads a negative LIMIT as no limit at all
+        rows = await self.fetch_page(self.cursors[self.page], size + (0 if last_page else 1)) if size > 0 else []
+        self.rows = rows[:size]
+        has_next = not last_page and len(rows) > size
+        if has_next and self.rows and len(self.cursors) == self.page + 1:
+            self.cursors.append(self.cursor(self.rows[-1]))
+        self.previous.disabled = self.page == 0
+        self.next.disabled = not has_next
+        return self.rows
+
+    def embed(self):
+        text = "\n".join(self.render_row(row) for row in self.rows)
+        embed = discord.Embed(title="Tokyo Banking", description=f"**{self.title}**\n{self.header}{text}"[:4096], color=0xce2222)
+        embed.set_footer(text=f"Page {self.page + 1}")
+        return embed
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author_id
+
+    async def turn(self, interaction, step):
+        self.page += step
+        try:
+            await self.load()
+        except QueryTimeout as error:
+            # Stay on the page already shown
+            self.page -= step
+            await interaction.response.send_message(f"⌛ {error}", ephemeral=True)
+            return
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction, button):
+        await self.turn(interaction, -1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction, button):
+        await self.turn(interaction, 1)
+
+# Send the first page of a listing; returns False (sending nothing) if it is empty
+async def send_pages(ctx, title, header, fetch_page, render_row, limit=None, cursor=None):
+    pager = Pager(ctx.author.id, title, header, fetch_page, render_row, limit, cursor)
+    if not await pager.load():
+        return False
+    if pager.next.disabled:
+        await ctx.send(embed=pager.embed())
+    else:
+        await ctx.send(embed=pager.embed(), view=pager)
+    return True
+
+# Admission control for the user commands. Each invocation costs tokens, one per row it
+# writes or page it may read, from three token buckets: the user's, the user's for that
+# command and the guild's. If any is short the command is turned away with the wait, so
+# one user can't flood a guild's database thread and one guild can't crowd out the rest.
+# At most MAX_IN_FLIGHT_COMMANDS admitted commands run at once; up to ADMISSION_QUEUE_SIZE
+# more wait up to ADMISSION_TIMEOUT seconds for a slot, and past that the bank says it's busy.
+# Admin commands bypass all of this.
+USER_RATE = (10, 1.0)  # (burst tokens, tokens per second)
+GUILD_RATE = (200, 50.0)
+COMMAND_RATES = {
+    "deposit": (4, 0.2),
+    "spend": (5, 0.5),
+    "transfer": (5, 0.5),
+    "history": (10, 0.2),
+    "leaderboard": (6, 0.2),
+}
+DEFAULT_COMMAND_RATE = (5, 1.0)
+RATE_BUCKETS_MAX = 20000
+MAX_IN_FLIGHT_COMMANDS = 64
+ADMISSION_QUEUE_SIZE = 256
+ADMISSION_TIMEOUT = 5.0
+
+class TokenBucket:
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Seconds until cost tokens are available (0 if they are now); a cost above the
+    # capacity is charged as a full bucket
+    def wait(self, cost, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, cost):
+        self.tokens -= min(cost, self.capacity)
+
+rate_buckets = OrderedDict()  # key -> TokenBucket, least recently used first
+admission_slots = asyncio.Semaphore(MAX_IN_FLIGHT_COMMANDS)
+admission_stats = {"admitted": 0, "throttled": 0, "busy": 0, "waiting": 0, "in_flight": 0}
+
+class Throttled(commands.CommandError):
+    pass
+
+def _rate_bucket(key, limits):
+    bucket = rate_buckets.get(key)
+    if bucket is None:
+        bucket = rate_buckets[key] = TokenBucket(*limits)
+        if len(rate_buckets) > RATE_BUCKETS_MAX:
+            # Least recently used, so long idle and refilled anyway
+            rate_buckets.popitem(last=False)
+    rate_buckets.move_to_end(key)
+    return bucket
+
+# Tokens an invocation costs, from its parsed arguments
+def command_cost(ctx):
+    args = dict(zip(ctx.command.clean_params, ctx.args[2:]), **ctx.kwargs)
+    name = ctx.command.name
+    if name == "deposit":
+        return len(args["currencies"].split(","))
+    if name == "history":
+        return -(-history_limit(args["limit"]) // PAGE_SIZE)
+    if name == "leaderboard":
+        return -(-max(1, min(args["limit"], LEADERBOARD_MAX)) // PAGE_SIZE)
+    return 1
+
+async def admit(ctx):
+    if admission_stats["waiting"] >= ADMISSION_QUEUE_SIZE:
+        admission_stats["busy"] += 1
+        raise Throttled("The bank is busy right now. Please try again in a few seconds.")
+
+    name = ctx.command.name
+    cost = command_cost(ctx)
+    buckets = [
+        (_rate_bucket(("guild", ctx.guild.id), GUILD_RATE), "This server's bank is busy."),
+        (_rate_bucket(("user", ctx.guild.id, ctx.author.id), USER_RATE), "You're using bank commands too quickly."),
+        (_rate_bucket(("command", ctx.guild.id, ctx.author.id, name), COMMAND_RATES.get(name, DEFAULT_COMMAND_RATE)),
+         f"You're using !{name} too quickly."),
+    ]
+    # Only charged once every bucket has room, so a refused command costs nothing
+    now = time.monotonic()
+    for bucket, reason in buckets:
+        wait = bucket.wait(cost, now)
+        if wait > 0:
+            admission_stats["throttled"] += 1
+            raise Throttled(f"{reason} Try again in {wait:.1f} s.")
+    for bucket, reason in buckets:
+        bucket.take(cost)
+
+    admission_stats["waiting"] += 1
+    try:
+        await asyncio.wait_for(admission_slots.acquire(), ADMISSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        admission_stats["busy"] += 1
+        raise Throttled("The bank is busy right now. Please try again in a few seconds.")
+    finally:
+        admission_stats["waiting"] -= 1
+    admission_stats["admitted"] += 1
+    admission_stats["in_flight"] += 1
+    ctx.admitted = True
+
+def release(ctx):
+    if getattr(ctx, "admitted", False):
+        ctx.admitted = False
+        admission_stats["in_flight"] -= 1
+        admission_slots.release()
+
+
+
+# Optional date bounds for the history commands, e.g. --since 2024-01-01 --until 2024-01-31 18:00
+class HistoryFlags(commands.FlagConverter, prefix="--", delimiter=" "):
+    since: str = None
+    until: str = None
+
+# history_admin can also read archived transactions with --archive yes
+class AdminHistoryFlags(HistoryFlags):
+    archive: bool = False
+
+# Turn the flags into epoch-millisecond bounds in local time. A date without a time
+# means the whole day, so --until 2024-01-31 includes the 31st.
+def history_range(flags):
+    if flags is None:
+        return None, None
+    bounds = []
+    for value, is_until in ((flags.since, False), (flags.until, True)):
+        if value is None:
+            bounds.append(None)
+            continue
+        try:
+            moment = datetime.datetime.fromisoformat(value.strip())
+        except ValueError:
+            raise commands.BadArgument(f"Invalid date: {value}. Use YYYY-MM-DD or YYYY-MM-DD HH:MM.")
+        if is_until and len(value.strip()) == 10:
+            moment += datetime.timedelta(days=1)
+        bounds.append(int(moment.timestamp() * 1000))
+    return bounds
+
+def history_cursor(t):
+    return t[5], t[0]
+
+def history_limit(limit):
+    return min(max(1, limit or 5), HISTORY_MAX)
+
+# Reconciliation runs one at a time, so a snapshot is never taken between another
+# run's replay and its repair
+reconcile_lock = asyncio.Lock()
+reconcile_executor = None
+
+# Replays a guild's ledger in the process pool and compares it with the balances (see
+# reconcile.py). With no drift, or with repair, a new snapshot is taken so the next run starts from here.
+async def run_reconciliation(guild_id, repair=False, full=False):
+    global reconcile_executor
+    async with reconcile_lock:
+        if reconcile_executor is None:
+            reconcile_executor = reconciliation.make_executor(RECONCILE_WORKERS)
+        # The workers read the database file directly, so make sure it exists and is migrated
+        partition = get_partition(guild_id)
+        await asyncio.wrap_future(partition.opened)
+        loop = asyncio.get_running_loop()
+        # Several partitions per worker so one busy partition doesn't leave the others idle
+        report = await loop.run_in_executor(None, reconciliation.reconcile, reconcile_executor,
+                                            partition.path, partition.archive_path, RECONCILE_WORKERS * 4, full)
+        report["new_snapshot"] = None
+        if not report["drift"] or repair:
+            report["new_snapshot"] = await record_reconciliation(guild_id, report["drift"] if repair else [])
+        return report
+
+# Next due time of each guild's payouts (None: no schedules), so idle guilds' databases
+# aren't opened on every check. Dropped whenever a guild's schedules change.
+payout_next_due = {}
+
+def describe_payout(kind, currency, amount, role_id):
+    who = "everyone" if role_id is None else f"<@&{role_id}>"
+    if kind == "payout":
+        return f"{amount:,} {currency} to {who}"
+    return f"{amount / 100:+g}% {currency} {'interest' if amount > 0 else 'decay'} for {who}"
+
+# "daily", "weekly", "hourly" or a count of hours, days or weeks such as 12h or 2w, in ms
+def parse_interval(text):
+    text = text.lower()
+    if text in PAYOUT_INTERVALS:
+        return PAYOUT_INTERVALS[text]
+    count, unit = text[:-1], text[-1:]
+    if not count.isdigit() or int(count) < 1 or unit not in PAYOUT_INTERVAL_UNITS:
+        raise commands.BadArgument(f"Invalid interval: {text}. Use hourly, daily, weekly or e.g. 12h, 3d, 2w.")
+    return int(count) * PAYOUT_INTERVAL_UNITS[unit]
+
+def format_interval(interval_ms):
+    for name, length in PAYOUT_INTERVALS.items():
+        if interval_ms == length:
+            return name
+    for unit, length in reversed(PAYOUT_INTERVAL_UNITS.items()):
+        if interval_ms % length == 0:
+            return f"every {interval_ms // length}{unit}"
+    return f"every {interval_ms} ms"
+
+# Applies every run of the guild's schedules that is due by now, oldest first. Role
+# payouts go to the role's current members, also when catching up. Returns the runs applied.
+async def run_due_payouts(guild, now):
+    applied = 0
+    for schedule in await get_due_payouts(guild.id, now):
+        schedule_id, role_id, interval_ms, due_at = schedule[0], schedule[4], schedule[5], schedule[6]
+        member_ids = None
+        if role_id is not None:
+            if not guild.chunked:
+                await guild.chunk(cache=True)
+            role = guild.get_role(role_id)
+            member_ids = [member.id for member in role.members] if role is not None else []
+        while due_at <= now:
+            result = await run_payout(guild.id, schedule, due_at, member_ids)
+            if result is None:
+                break
+            applied += 1
+            print(f"Payout schedule #{schedule_id} of guild {guild.id} for {format_timestamp(due_at)}: "
+                  f"{result[1]:,} {schedule[2]} to {result[0]:,} users")
+            due_at += interval_ms
+    return applied
+
+
+# Commands are grouped into cogs, added to the bot by create_bot
+class UserCommands(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def cog_before_invoke(self, ctx):
+        await admit(ctx)
+
+    async def cog_after_invoke(self, ctx):
+        release(ctx)
+
+    @commands.command()
+    async def usercommands(self, ctx):
+        help_text = """
     **User Commands:**
 
     **!deposit <currency1>,<currency2>... <amount1>,<amount2>... <reason>**  
@@ -111,8 +1894,14 @@ async def usercommands(ctx):
     **!userbalance [currency] <@user>**  
     Checks the balance of a specific currency or all currencies.
 
-    **!history <@user> [limit]**  
-    Views transaction history (default limit is 5 transactions).
+    **!history [limit] [--since <date>] [--until <date>]**  
+    Views transaction history (default limit is 5 transactions, at most 100), optionally between two dates (YYYY-MM-DD).
+
+    **!leaderboard <currency> [limit]**  
+    Shows the users with the most of a currency (default top 10).
+
+    **!economy**  
+    Shows the total supply of each currency and how much was deposited and spent recently.
 
     **!transfer <@user> <amount>**  
     Transfers a specified amount of Yen from the user’s account to another user. Logs the transaction details, including the sender, receiver, and amount.  
@@ -120,253 +1909,295 @@ async def usercommands(ctx):
 
     """
 
-    await send_embed(ctx, "Bot Commands", help_text)
+        await send_embed(ctx, "Bot Commands", help_text)
 
+    @commands.command()
+    async def history(self, ctx, limit: typing.Optional[int] = 5, *, flags: HistoryFlags = None):
+        user_id = ctx.author.id
+        since, until = history_range(flags)
 
-@bot.command()
-async def admincommands(ctx):
-    help_text = """
-    **Admin Commands:**
+        async def fetch_page(cursor, page_size):
+            return await get_history_page(ctx.guild.id, user_id, cursor, page_size, since, until)
 
-    **!give <@user> <currency> <amount>**  
-    Gives the specified amount of currency to a user. Logs the transaction.
+        def render_row(t):
+            return f"📅 {format_timestamp(t[5])} - **{t[1].capitalize()} {t[2]} {t[3]}** | *{t[4]}*"
 
-    **!giveall <currency> <amount>**  
-    Distributes a specified amount of currency to all users. Logs transactions for all affected users.
+        if not await send_pages(ctx, "Your Transactions", "", fetch_page, render_row, history_limit(limit), history_cursor):
+            await send_embed(ctx, "Transaction History", "📜 You have no transaction history.")
 
-    **!multi_give <currency> <amount> <@user1> <@user2> ...**  
-    Gives a specified amount of currency to multiple users at once. Logs transactions for each affected user.
+    @commands.command()
+    async def deposit(self, ctx, currencies: str, amounts: str, *, reason: str = "No reason provided"):
+        # Split the input strings into lists
+        currency_list = currencies.upper().split(",")
+        amount_list = amounts.split(",")
 
-    **!viewallbalances**  
-    Displays the balance of all users in the server.
+        # Validate the number of currencies and amounts match
+        if len(currency_list) != len(amount_list):
+            await send_embed(ctx, "Error", "❌ The number of currencies and amounts don't match. Please try again.")
+            return
 
-    **!history_admin <@user> [limit]**  
-    Views the transaction history of a specific user. Default limit is 5 transactions. 
-    
-    **!remove <currency> <amount> <member1> <member2>...**
-    Allows an admin to remove a specified amount of currency from one or more users.
+        # Validate each currency
+        for currency in currency_list:
+            if currency not in CURRENCY_TYPES:
+                await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+                return
 
-    **view_pending**
-    Checks pending deposits.
+        user_id = ctx.author.id
 
-    **approve_deposit <transaction_id1>,<transaction_id2>... <bool>**
-    Allows an admin to approve multiple or one transactions.
-    """
-    await send_embed(ctx, "Bot Commands", help_text)
+        # List to store formatted currency/amount pairs
+        formatted_deposits = []
+        deposits = []
 
+        # Iterate through the currencies and amounts to build the deposit
+        for currency, amount_str in zip(currency_list, amount_list):
+            try:
+                amount = int(amount_str)  # Convert the amount to an integer
+            except ValueError:
+                await send_embed(ctx, "Error", f"❌ Invalid amount: {amount_str}. Please provide valid numeric values.")
+                return
 
+            deposits.append((currency, amount))
 
-@bot.command()
-async def history(ctx, limit: int = 5):
-    user_id = ctx.author.id
-    c.execute("SELECT type, amount, currency, reason, timestamp FROM transactions WHERE user_id=? ORDER BY id DESC LIMIT ?", (user_id, limit))
-    transactions = c.fetchall()
+            # Format the deposit (add yen symbol and commas if it's yen)
+            if currency == "YEN":
+                formatted_deposit = f"YEN: ¥{amount:,}"  # Format yen with commas and prepend yen symbol
+            else:
+                formatted_deposit = f"{currency}: {amount:,}"  # Format other currencies with commas
 
-    if not transactions:
-        await send_embed(ctx, "Transaction History", "📜 You have no transaction history.")
-        return
+            # Append formatted deposit to the list
+            formatted_deposits.append(formatted_deposit)
 
-    history_text = "\n".join([f"📅 {t[4]} - **{t[0].capitalize()} {t[1]} {t[2]}** | *{t[3]}*" for t in transactions])
-    await send_embed(ctx, "Your Transactions", history_text)
+        # Log all deposits as pending in one write
+        await add_pending_deposits(ctx.guild.id, user_id, deposits, reason)
 
-@bot.command()
-async def deposit(ctx, currencies: str, amounts: str, *, reason: str = "No reason provided"):
-    # Split the input strings into lists
-    currency_list = currencies.upper().split(",")
-    amount_list = amounts.split(",")
+        # Send the confirmation embed with formatted deposits
+        await send_embed(ctx, "Deposit Pending", f"💰 {ctx.author.mention}, your deposits of the following currencies are pending approval:\n"
+                                                 + "\n".join(formatted_deposits) +
+                                                 f"\n**Reason:** {reason}\nPlease wait for approval from an admin.")
 
-    # Validate the number of currencies and amounts match
-    if len(currency_list) != len(amount_list):
-        await send_embed(ctx, "Error", "❌ The number of currencies and amounts don't match. Please try again.")
-        return
-
-    # Validate each currency
-    for currency in currency_list:
+    # Spend command
+    @commands.command()
+    async def spend(self, ctx, currency: str, amount: int, *, reason: str = "No reason provided"):
+        currency = currency.upper()
         if currency not in CURRENCY_TYPES:
             await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
             return
 
-    user_id = ctx.author.id
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if amount <= 0:
+            await send_embed(ctx, "Error", "❌ The amount must be greater than 0.")
+            return
 
-    # List to store formatted currency/amount pairs
-    formatted_deposits = []
+        user_id = ctx.author.id
+        spent, new_balance = await spend_currency(ctx.guild.id, user_id, currency, amount, reason)
 
-    # Iterate through the currencies and amounts to log the deposit
-    for currency, amount_str in zip(currency_list, amount_list):
-        try:
-            amount = int(amount_str)  # Convert the amount to an integer
-        except ValueError:
-            await send_embed(ctx, "Error", f"❌ Invalid amount: {amount_str}. Please provide valid numeric values.")
+        if not spent:
+            await send_embed(ctx, "Error", f"❌ {ctx.author.mention}, you don't have enough {currency}! Current balance: {new_balance}")
             return
 
-        # Log the deposit as pending
-        c.execute("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp, status) VALUES (?, ?, ?, ?, ?, ?, ?)", 
-                  (user_id, "deposit", amount, currency, reason, timestamp, "PENDING"))
-        conn.commit()
+        currency_symbol = "¥" if currency == "YEN" else ""
+        formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
+        formatted_balance = f"{currency_symbol}{new_balance:,}" if currency == "YEN" else f"{new_balance:,} {currency}"
+        await send_embed(ctx, "Spend Successful", f"🛒 {ctx.author.mention} spent {formatted_amount} {currency}.\n**Reason:** {reason}\n**New balance:** {formatted_balance}")
 
-        # Format the deposit (add yen symbol and commas if it's yen)
-        if currency == "YEN":
-            formatted_deposit = f"YEN: ¥{amount:,}"  # Format yen with commas and prepend yen symbol
-        else:
-            formatted_deposit = f"{currency}: {amount:,}"  # Format other currencies with commas
+    #User Command: Transfer currency.
+    @commands.command()
+    async def transfer(self, ctx, member: discord.Member, amount: int):
+        sender_id = ctx.author.id
+        receiver_id = member.id
 
-        # Append formatted deposit to the list
-        formatted_deposits.append(formatted_deposit)
+        if sender_id == receiver_id:
+            await send_embed(ctx, "Transfer Failed", "❌ You cannot transfer yen to yourself.")
+            return
 
-    # Send the confirmation embed with formatted deposits
-    await send_embed(ctx, "Deposit Pending", f"💰 {ctx.author.mention}, your deposits of the following currencies are pending approval:\n"
-                                             + "\n".join(formatted_deposits) +
-                                             f"\n**Reason:** {reason}\nPlease wait for approval from an admin.")
+        if amount <= 0:
+            await send_embed(ctx, "Transfer Failed", "❌ The amount must be greater than 0.")
+            return
 
+        # Update balances and log the transactions
+        transferred, new_sender_balance, receiver_balance = await transfer_yen(ctx.guild.id, sender_id, receiver_id, amount, ctx.author.name, member.name)
 
+        if not transferred:
+            await send_embed(ctx, "Transfer Failed", f"❌ {ctx.author.mention}, you don't have enough yen! Current balance: ¥{new_sender_balance:,}")
+            return
 
-# Spend command
-@bot.command()
-async def spend(ctx, currency: str, amount: int, *, reason: str = "No reason provided"):
-    currency = currency.upper()
-    if currency not in CURRENCY_TYPES:
-        await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
-        return
+        # Create a description for the embed
+        description = (
+            f"💸 {ctx.author.mention} successfully transferred ¥{amount:,} to {member.mention}.\n"
+            f"**Your new balance:** ¥{new_sender_balance:,}\n"
+            f"**Receiver new balance:** ¥{receiver_balance:,}"
+        )
 
-    user_id = ctx.author.id
-    balance = get_balance(user_id, currency)
+        # Send the embed message
+        await send_embed(ctx, "Yen Transfer Successful", description)
 
-    if amount > balance:
-        await send_embed(ctx, "Error", f"❌ {ctx.author.mention}, you don't have enough {currency}! Current balance: {balance}")
-        return
+    @commands.command()
+    async def userbalance(self, ctx, member: discord.Member, currency: str = None):
+        user_id = member.id
+        if currency:
+            currency = currency.upper()
+            if currency not in CURRENCY_TYPES:
+                await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+                return
+            balance = await get_balance(ctx.guild.id, user_id, currency)
+            formatted_balance = f"¥{balance:,}" if currency == "YEN" else f"{balance:,} {currency}"
+            await send_embed(ctx, "Balance", f"💳 {member.name}, your {currency} balance is {formatted_balance}.")
+        else:
+            balances = await get_balances(ctx.guild.id, user_id)
+            balance_text = "\n".join([f"**{cur}:** {'¥' + format(balances[cur], ',') if cur == 'YEN' else format(balances[cur], ',')}" for cur in CURRENCY_TYPES])
+            await send_embed(ctx, "Balance", f"💳 {member.name}, your balances are:\n{balance_text}")
+
+    @commands.command()
+    async def balance(self, ctx, currency: str = None):
+        user_id = ctx.author.id
+        if currency:
+            currency = currency.upper()
+            if currency not in CURRENCY_TYPES:
+                await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+                return
+            balance = await get_balance(ctx.guild.id, user_id, currency)
+            formatted_balance = f"¥{balance:,}" if currency == "YEN" else f"{balance:,} {currency}"
+            await send_embed(ctx, "Balance", f"💳 {ctx.author.mention}, your {currency} balance is {formatted_balance}.")
+        else:
+            balances = await get_balances(ctx.guild.id, user_id)
+            balance_text = "\n".join([f"**{cur}:** {'¥' + format(balances[cur], ',') if cur == 'YEN' else format(balances[cur], ',')}" for cur in CURRENCY_TYPES])
+            await send_embed(ctx, "Balance", f"💳 {ctx.author.mention}, your balances are:\n{balance_text}")
 
-    new_balance = balance - amount
-    c.execute(f"UPDATE users SET {currency}=? WHERE user_id=?", (new_balance, user_id))
-    conn.commit()
+    # Command: Show the users with the most of a currency
+    @commands.command()
+    async def leaderboard(self, ctx, currency: str, limit: int = 10):
+        currency = currency.upper()
+        if currency not in CURRENCY_TYPES:
+            await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+            return
 
-    log_transaction(user_id, "spend", amount, currency, reason)
-    currency_symbol = "¥" if currency == "YEN" else ""
-    formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
-    formatted_balance = f"{currency_symbol}{new_balance:,}" if currency == "YEN" else f"{new_balance:,} {currency}"
-    await send_embed(ctx, "Spend Successful", f"🛒 {ctx.author.mention} spent {formatted_amount} {currency}.\n**Reason:** {reason}\n**New balance:** {formatted_balance}")
+        rows = await get_leaderboard(ctx.guild.id, currency, max(1, min(limit, LEADERBOARD_MAX)))
+        if not rows:
+            await send_embed(ctx, "Leaderboard", "No users have a balance yet.")
+            return
+        names = await resolve_members(ctx.guild, [user_id for user_id, amount in rows])
+        lines = [f"**{rank}.** {names[user_id][1]} - {'¥' + format(amount, ',') if currency == 'YEN' else f'{amount:,} {currency}'}"
+                 for rank, (user_id, amount) in enumerate(rows, start=1)]
+        await send_embed(ctx, f"🏆 {currency} Leaderboard", "\n".join(lines))
+
+    # Command: Show the size of the economy and recent activity
+    @commands.command()
+    async def economy(self, ctx):
+        economy = await get_economy(ctx.guild.id, ECONOMY_DAYS)
+        lines = []
+        for currency in CURRENCY_TYPES:
+            supply, deposited, spent = economy.get(currency, (0, 0, 0))
+            lines.append(f"**{currency}:** {supply:,} in circulation\n"
+                         f"Last {ECONOMY_DAYS} days: {deposited:,} deposited ({deposited / ECONOMY_DAYS:,.1f}/day), "
+                         f"{spent:,} spent ({spent / ECONOMY_DAYS:,.1f}/day)")
+        await send_embed(ctx, "📊 Economy", "\n".join(lines))
+
+
+class AdminCommands(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.command()
+    async def admincommands(self, ctx):
+        help_text = """
+    **Admin Commands:**
 
-#User Command: Transfer currency.
-@bot.command()
-async def transfer(ctx, member: discord.Member, amount: int):
-    sender_id = ctx.author.id
-    receiver_id = member.id
+    **!give <@user> <currency> <amount>**  
+    Gives the specified amount of currency to a user. Logs the transaction.
 
-    if sender_id == receiver_id:
-        await send_embed(ctx, "Transfer Failed", "❌ You cannot transfer yen to yourself.")
-        return
+    **!giveall <currency> <amount>**  
+    Distributes a specified amount of currency to all users. Logs transactions for all affected users.
+
+    **!multi_give <currency> <amount> <@user1> <@user2> ...**  
+    Gives a specified amount of currency to multiple users at once. Logs transactions for each affected user.
 
-    sender_balance = get_balance(sender_id, "yen")
+    **!viewallbalances**  
+    Displays the balance of all users in the server.
+
+    **!history_admin <@user> [limit] [--since <date>] [--until <date>] [--archive yes]**  
+    Views the transaction history of a specific user. Default limit is 5 transactions. 
     
-    if amount > sender_balance:
-        await send_embed(ctx, "Transfer Failed", f"❌ {ctx.author.mention}, you don't have enough yen! Current balance: ¥{sender_balance:,}")
-        return
+    **!remove <currency> <amount> <member1> <member2>...**
+    Allows an admin to remove a specified amount of currency from one or more users.
 
-    # Update balances
-    new_sender_balance = sender_balance - amount
-    receiver_balance = get_balance(receiver_id, "yen") + amount
+    **view_pending**
+    Checks pending deposits.
 
+    **approve_deposit <transaction_id1>,<transaction_id2>... <bool>**
+    Allows an admin to approve multiple or one transactions.
 
-    c.execute("UPDATE users SET yen=? WHERE user_id=?", (new_sender_balance, sender_id))
-    c.execute("UPDATE users SET yen=? WHERE user_id=?", (receiver_balance, receiver_id))
-    conn.commit()
+    **!perfstats**
+    Shows command, database and message latency statistics.
 
-    # Log the transactions
-    log_transaction(sender_id, "transfer_out", amount, "yen", f"Sent to {member.name}")
-    log_transaction(receiver_id, "transfer_in", amount, "yen", f"Received from {ctx.author.name}")
+    **!archive [days] [compact]**
+    Archives settled transactions older than the given days (default 90).
 
-    # Create a description for the embed
-    description = (
-        f"💸 {ctx.author.mention} successfully transferred ¥{amount:,} to {member.mention}.\n"
-        f"**Your new balance:** ¥{new_sender_balance:,}\n"
-        f"**Receiver new balance:** ¥{receiver_balance:,}"
-    )
+    **!reconcile [repair] [full]**
+    Checks every balance against the transaction log and lists the differences. With repair, logs adjustments for them.
 
-    # Send the embed message
-    await send_embed(ctx, "Yen Transfer Successful", description)
+    **!export <users|transactions> [csv|jsonl]**
+    Sends the table as a gzipped CSV or JSONL file.
 
-@bot.command()
-async def userbalance(ctx, member: discord.Member, currency: str = None):
-    user_id = member.id
-    if currency:
-        currency = currency.upper()
-        if currency not in CURRENCY_TYPES:
-            await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
-            return
-        balance = get_balance(user_id, currency)
-        formatted_balance = f"¥{balance:,}" if currency == "YEN" else f"{balance:,} {currency}"
-        await send_embed(ctx, "Balance", f"💳 {member.name}, your {currency} balance is {formatted_balance}.")
-    else:
-        balance_text = "\n".join([f"**{cur}:** {'¥' + format(get_balance(user_id, cur), ',') if cur == 'YEN' else format(get_balance(user_id, cur), ',')}" for cur in CURRENCY_TYPES])
-        await send_embed(ctx, "Balance", f"💳 {member.name}, your balances are:\n{balance_text}")
+    **!import <users|transactions>** (with a .csv or .jsonl file attached, optionally .gz)
+    Sets users' balances from the file, or appends the transactions to the ledger and applies them to the balances.
 
-@bot.command()
-async def balance(ctx, currency: str = None):
-    user_id = ctx.author.id
-    if currency:
+    **!add_payout <currency> <amount> <daily|weekly|hourly|12h|3d|2w> [@role] [reason]**
+    Pays the amount to everyone (or the role's members) on a schedule.
+
+    **!add_interest <currency> <percent> <interval> [@role] [reason]**
+    Adds the percentage of each positive balance on a schedule; a negative percentage decays balances.
+
+    **!view_payouts** / **!remove_payout <id>**
+    Lists the payout schedules, or stops one.
+    """
+        await send_embed(ctx, "Bot Commands", help_text)
+
+    # Admin Command: Give currency to a user
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def give(self, ctx, member: discord.Member, currency: str, amount: int):
         currency = currency.upper()
         if currency not in CURRENCY_TYPES:
             await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
             return
-        balance = get_balance(user_id, currency)
-        formatted_balance = f"¥{balance:,}" if currency == "YEN" else f"{balance:,} {currency}"
-        await send_embed(ctx, "Balance", f"💳 {ctx.author.mention}, your {currency} balance is {formatted_balance}.")
-    else:
-        balance_text = "\n".join([f"**{cur}:** {'¥' + format(get_balance(user_id, cur), ',') if cur == 'YEN' else format(get_balance(user_id, cur), ',')}" for cur in CURRENCY_TYPES])
-        await send_embed(ctx, "Balance", f"💳 {ctx.author.mention}, your balances are:\n{balance_text}")
-# Admin Command: Give currency to a user
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def give(ctx, member: discord.Member, currency: str, amount: int):
-    currency = currency.upper()
-    if currency not in CURRENCY_TYPES:
-        await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
-        return
 
-    user_id = member.id
-    balance = get_balance(user_id, currency)
-    new_balance = balance + amount
-
-    c.execute(f"UPDATE users SET {currency}=? WHERE user_id=?", (new_balance, user_id))
-    conn.commit()
-    log_transaction(user_id, "admin_give", amount, currency, f"Given by {ctx.author.name}")
-    currency_symbol = "¥" if currency == "YEN" else ""
-    formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
-    formatted_balance = f"{currency_symbol}{new_balance:,}" if currency == "YEN" else f"{new_balance:,} {currency}"
-    await send_embed(ctx, "Transaction Successful", f"✅ {ctx.author.mention} gave {formatted_amount} {currency} to {member.mention}.\n**New balance:** {formatted_balance}")
-
-
-# Admin command to approve or deny deposits
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def approve_deposit(ctx, transaction_ids: str, approve: bool):
-    # Split transaction IDs and convert to integers
-    transaction_id_list = transaction_ids.split(",")
+        user_id = member.id
+        new_balance = await give_currency(ctx.guild.id, user_id, currency, amount, "admin_give", f"Given by {ctx.author.name}")
+        currency_symbol = "¥" if currency == "YEN" else ""
+        formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
+        formatted_balance = f"{currency_symbol}{new_balance:,}" if currency == "YEN" else f"{new_balance:,} {currency}"
+        await send_embed(ctx, "Transaction Successful", f"✅ {ctx.author.mention} gave {formatted_amount} {currency} to {member.mention}.\n**New balance:** {formatted_balance}")
+
+    # Admin command to approve or deny deposits
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def approve_deposit(self, ctx, transaction_ids: str, approve: bool):
+        # Split transaction IDs and convert to integers
+        transaction_id_list = transaction_ids.split(",")
     
-    # Track results
-    approved_transactions = []
-    denied_transactions = []
-    errors = []
-
-    for transaction_id in transaction_id_list:
-        try:
-            transaction_id = int(transaction_id.strip())  # Convert to integer
-            # Fetch the transaction details
-            c.execute("SELECT user_id, amount, currency FROM transactions WHERE id=? AND status='PENDING'", (transaction_id,))
-            transaction = c.fetchone()
-
+        # Track results
+        approved_transactions = []
+        denied_transactions = []
+        errors = []
+
+        parsed_ids = []
+        for transaction_id in transaction_id_list:
+            try:
+                parsed_ids.append(int(transaction_id.strip()))  # Convert to integer
+            except ValueError:
+                errors.append(f"❌ Invalid transaction ID: {transaction_id}. Please use numeric values.")
+
+        # Update every transaction status (and the balances, if approved) in one batch
+        transactions = await settle_deposits(ctx.guild.id, parsed_ids, approve) if parsed_ids else []
+        members = await resolve_members(ctx.guild, [t[0] for t in transactions if t])
+
+        for transaction_id, transaction in zip(parsed_ids, transactions):
             if not transaction:
                 errors.append(f"❌ No pending transaction found with ID {transaction_id}.")
                 continue
 
-            user_id, amount, currency = transaction
-            status = "APPROVED" if approve else "DENIED"
-
-            # Update transaction status
-            c.execute("UPDATE transactions SET status=? WHERE id=?", (status, transaction_id))
-            conn.commit()
-            
-            user = ctx.guild.get_member(user_id)  # Get the user object by user_id
+            user_id, amount, currency, new_balance = transaction
+        
+            name, mention = members[user_id]
 
             # Format amount correctly (add yen symbol and commas if necessary)
             if currency == "YEN":
@@ -375,197 +2206,522 @@ async def approve_deposit(ctx, transaction_ids: str, approve: bool):
                 formatted_amount = f"{amount:,} {currency}"
 
             if approve:
-                # If approved, update user balance
-                new_balance = get_balance(user_id, currency) + amount
-                c.execute(f"UPDATE users SET {currency}=? WHERE user_id=?", (new_balance, user_id))
-                conn.commit()
-
                 # Format new balance correctly
                 if currency == "YEN":
                     formatted_balance = f"¥{new_balance:,}"
                 else:
                     formatted_balance = f"{new_balance:,} {currency}"
 
-                approved_transactions.append(f"✅ **{formatted_amount}** approved by {ctx.author.mention} from {user.mention}(New balance: **{formatted_balance}**)")
+                approved_transactions.append(f"✅ **{formatted_amount}** approved by {ctx.author.mention} from {mention}(New balance: **{formatted_balance}**)")
 
             else:
-                denied_transactions.append(f"❌ **{formatted_amount}** denied by {ctx.author.mention} from {user.mention}")
-
-        except ValueError:
-            errors.append(f"❌ Invalid transaction ID: {transaction_id}. Please use numeric values.")
-
-    # Build the response message
-    response = []
-    if approved_transactions:
-        response.append("### ✅ Approved Transactions:\n" + "\n".join(approved_transactions))
-    if denied_transactions:
-        response.append("### ❌ Denied Transactions:\n" + "\n".join(denied_transactions))
-    if errors:
-        response.append("### ⚠️ Errors:\n" + "\n".join(errors))
-
-    await send_embed(ctx, "Deposit Approval Results", "\n\n".join(response) if response else "No transactions processed.")
-
-
-# Admin command to view all pending transactions
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def view_pending(ctx):
-    c.execute("SELECT id, user_id, amount, currency, reason, timestamp FROM transactions WHERE status='PENDING'")
-    pending_transactions = c.fetchall()
-
-    if not pending_transactions:
-        await send_embed(ctx, "No Pending Deposits", "📜 No deposits are pending approval.")
-        return
-
-    pending_text = ""
-    for transaction in pending_transactions:
-        user_id = transaction[1]
-        user = ctx.guild.get_member(user_id)  # Get the user object by user_id
-
-        if user:
-            username = user.name  # Get the username
-            mention = user.mention  # Use mention for clickable link
-        else:
-            username = f"Unknown user ({user_id})"
-            mention = "Unknown user"
-
-        pending_text += f"ID: {transaction[0]} | {mention} | {transaction[2]} {transaction[3]} | Reason: {transaction[4]} | Time: {transaction[5]}\n"
-
-    await send_embed(ctx, "Pending Deposits", pending_text)
-
-
-
-#Admin Command: Give all users. 
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def giveall(ctx, currency: str, amount: int):
-    currency = currency.upper()
-    if currency not in CURRENCY_TYPES:
-        await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
-        return
-
-    c.execute("UPDATE users SET {} = {} + ?".format(currency, currency), (amount,))
-    conn.commit()
+                denied_transactions.append(f"❌ **{formatted_amount}** denied by {ctx.author.mention} from {mention}")
+
+        # Build the response message
+        response = []
+        if approved_transactions:
+            response.append("### ✅ Approved Transactions:\n" + "\n".join(approved_transactions))
+        if denied_transactions:
+            response.append("### ❌ Denied Transactions:\n" + "\n".join(denied_transactions))
+        if errors:
+            response.append("### ⚠️ Errors:\n" + "\n".join(errors))
+
+        await send_embed(ctx, "Deposit Approval Results", "\n\n".join(response) if response else "No transactions processed.")
+
+    # Admin command to view all pending transactions
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def view_pending(self, ctx):
+        members = {}
+
+        # Resolve the whole page's users in one batch before it is rendered
+        async def fetch_page(after_id, page_size):
+            rows = await get_pending_page(ctx.guild.id, after_id, page_size)
+            members.update(await resolve_members(ctx.guild, [row[1] for row in rows]))
+            return rows
+
+        def render_row(transaction):
+            name, mention = members[transaction[1]]
+            return f"ID: {transaction[0]} | {mention} | {transaction[2]} {transaction[3]} | Reason: {transaction[4]} | Time: {format_timestamp(transaction[5])}"
+
+        if not await send_pages(ctx, "Pending Deposits", "", fetch_page, render_row):
+            await send_embed(ctx, "No Pending Deposits", "📜 No deposits are pending approval.")
+
+    #Admin Command: Give all users. 
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def giveall(self, ctx, currency: str, amount: int):
+        currency = currency.upper()
+        if currency not in CURRENCY_TYPES:
+            await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+            return
 
-    # Fetch all user IDs
-    c.execute("SELECT user_id FROM users")
-    users = c.fetchall()
+        paid = await give_all(ctx.guild.id, currency, amount, f"Given to all users by {ctx.author.name}")
 
-    for (user_id,) in users:
-        log_transaction(user_id, "admin_giveall", amount, currency, f"Given to all users by {ctx.author.name}")
-    currency_symbol = "¥" if currency == "YEN" else ""
-    formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
-    await send_embed(ctx, "Give All", f"✅ {ctx.author.mention} gave {formatted_amount} {currency} to all users!")
+        currency_symbol = "¥" if currency == "YEN" else ""
+        formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
+        await send_embed(ctx, "Give All", f"✅ {ctx.author.mention} gave {formatted_amount} {currency} to all users! ({paid:,} users)")
 
-#Admin Command: Give multiple users' balances.
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def multi_give(ctx, currency: str, amount: int, *members: discord.Member):
-    currency = currency.upper()
-    if currency not in CURRENCY_TYPES:
-        await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
-        return
+    #Admin Command: Give multiple users' balances.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def multi_give(self, ctx, currency: str, amount: int, *members: discord.Member):
+        currency = currency.upper()
+        if currency not in CURRENCY_TYPES:
+            await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+            return
 
-    for member in members:
-        user_id = member.id
-        balance = get_balance(user_id, currency)
-        new_balance = balance + amount
+        if not members:
+            await send_embed(ctx, "Error", "You must specify at least one member.")
+            return
 
-        c.execute("UPDATE users SET {}=? WHERE user_id=?".format(currency), (new_balance, user_id))
-        conn.commit()
-        log_transaction(user_id, "admin_multi_give", amount, currency, f"Given by {ctx.author.name}")
+        await give_many(ctx.guild.id, [member.id for member in members], currency, amount, f"Given by {ctx.author.name}")
         currency_symbol = "¥" if currency == "YEN" else ""
         formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
-    await send_embed(ctx, "Multi Give", f"✅ {ctx.author.mention} gave {formatted_amount} {currency} to {', '.join([member.mention for member in members])}.")
-
-# Admin Command: Check all users' balances.
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def viewallbalances(ctx):
-    c.execute("SELECT user_id, AP, SP, yen, reputation FROM users")
-    users = c.fetchall()
-
-    if not users:
-        await ctx.send("📊 No users found in the database.")
-        return
+        await send_embed(ctx, "Multi Give", f"✅ {ctx.author.mention} gave {formatted_amount} {currency} to {', '.join([member.mention for member in members])}.")
+
+    # Admin Command: Check all users' balances.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def viewallbalances(self, ctx):
+        def render_row(u):
+            return f"<@{u[0]}> - AP: {u[1]:,}, SP: {u[2]:,}, Yen: \u00a5{u[3]:,}, Reputation: {u[4]:,}"
+
+        async def fetch_page(after_user_id, page_size):
+            return await get_balances_page(ctx.guild.id, after_user_id, page_size)
+
+        if not await send_pages(ctx, "📊 All Users' Balances:", "", fetch_page, render_row):
+            await ctx.send("📊 No users found in the database.")
+
+    # Admin Command: Download a table as a gzipped file.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def export(self, ctx, table: str = "users", fmt: str = "csv"):
+        table, fmt = table.lower(), fmt.lower()
+        if table not in bulk.COLUMNS or fmt not in bulk.FORMATS:
+            await send_embed(ctx, "Error", "❌ Usage: `!export <users|transactions> [csv|jsonl]`")
+            return
 
-    balance_text = "\n".join([f"<@{u[0]}> - AP: {u[1]:,}, SP: {u[2]:,}, Yen: \u00a5{u[3]:,}, Reputation: {u[4]:,}" for u in users])
-    await ctx.send(f"📊 **All Users' Balances:**\n{balance_text}")
+        filename = f"{table}-{ctx.guild.id}.{fmt}.gz"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, filename)
+            rows = await export_table(ctx.guild.id, table, fmt, path)
+            size = os.path.getsize(path)
+            if size > ctx.guild.filesize_limit:
+                await send_embed(ctx, "Error", f"❌ The export is {size / 2**20:.1f} MiB, over this server's upload limit of "
+                                               f"{ctx.guild.filesize_limit / 2**20:.0f} MiB. Run `python bulk.py export` on the database instead.")
+                return
+            await ctx.send(f"📦 Exported {rows:,} {table} rows.", file=discord.File(path, filename=filename))
+
+    # Admin Command: Load users or transactions from an attached file.
+    @commands.command(name="import")
+    @commands.has_permissions(administrator=True)
+    async def import_(self, ctx, table: str):
+        table = table.lower()
+        attachments = ctx.message.attachments
+        if table not in bulk.COLUMNS or not attachments:
+            await send_embed(ctx, "Error", "❌ Usage: `!import <users|transactions>` with a .csv or .jsonl file (optionally .gz) attached.")
+            return
+        try:
+            fmt = bulk.file_format(attachments[0].filename)
+        except ValueError as error:
+            await send_embed(ctx, "Error", f"❌ {error}")
+            return
 
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "import")
+            await attachments[0].save(path)
+            try:
+                records = await import_table(ctx.guild.id, table, fmt, path, f"Imported by {ctx.author.name}")
+            except ValueError as error:
+                await send_embed(ctx, "Error", f"❌ Nothing was imported: {error}")
+                return
+        await send_embed(ctx, "Import", f"📥 Imported {records:,} {table} records from {attachments[0].filename}.")
+
+    # Admin Command: View any user's transaction history.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def history_admin(self, ctx, member: discord.Member, limit: typing.Optional[int] = 5, *, flags: AdminHistoryFlags = None):
+        user_id = member.id
+        since, until = history_range(flags)
+        include_archive = flags is not None and flags.archive
+
+        async def fetch_page(cursor, page_size):
+            return await get_history_page(ctx.guild.id, user_id, cursor, page_size, since, until, include_archive)
+
+        def render_row(t):
+            return f"📅 `{format_timestamp(t[5])}` - **{t[1].capitalize()} {t[2]:,} {'¥' if t[3] == 'YEN' else t[3]}** | *{t[4]}*"
+
+        hint = ""
+        if not include_archive:
+            archived = await get_archived_count(ctx.guild.id, user_id)
+            if archived:
+                hint = f"🗄️ {archived:,} older transactions are archived; add `--archive yes` to include them.\n"
+        header = f"📜 {ctx.author.mention}, transactions for {member.mention}:\n{hint}"
+        if not await send_pages(ctx, "Transaction History", header, fetch_page, render_row, max(1, limit or 5), history_cursor):
+            await send_embed(ctx, "Transaction History", f"{hint}📜 No transactions found for {member.mention}.")
+
+    #Admin Command: Remove any user's transaction history.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def remove(self, ctx, currency: str, amount: int, *members: discord.Member):
+        if not members:
+            await send_embed(ctx, "Error", "You must specify at least one member.")
+            return
 
+        currency = currency.upper()
+        if currency not in CURRENCY_TYPES:
+            await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+            return
 
-# Admin Command: View any user's transaction history.
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def history_admin(ctx, member: discord.Member, limit: int = 5):
-    user_id = member.id
-    c.execute("SELECT type, amount, currency, reason, timestamp FROM transactions WHERE user_id=? ORDER BY id DESC LIMIT ?", (user_id, limit))
-    transactions = c.fetchall()
-    if not transactions:
-        await send_embed(ctx, "Transaction History", f"📜 No transactions found for {member.mention}.")
-        return
+        results = await remove_many(ctx.guild.id, [member.id for member in members], currency, amount, f"Removed by {ctx.author.name}")
 
-    history_text = "\n".join([f"📅 `{t[4]}` - **{t[0].capitalize()} {t[1]:,} {'¥' if t[2] == 'YEN' else t[2]}** | *{t[3]}*" for t in transactions])
+        currency_symbol = "¥" if currency == "YEN" else ""
+        formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
+        removed = []
+        errors = []
+        for member, (user_id, current_balance, new_balance) in zip(members, results):
+            if current_balance == 0:
+                errors.append(f"{member.mention} already has 0 {currency}. Cannot remove more.")
+                continue  # Skip this user and move to the next
+
+            formatted_balance = f"{currency_symbol}{new_balance:,}" if currency == "YEN" else f"{new_balance:,} {currency}"
+            removed.append(f"{member.mention} - New balance: {formatted_balance}.")
+
+        # Build one summary reply for the whole batch
+        response = []
+        if removed:
+            response.append(f"{formatted_amount} removed from:\n" + "\n".join(removed))
+        if errors:
+            response.append("### ⚠️ Errors:\n" + "\n".join(errors))
+        await send_embed(ctx, "Admin Action", "\n\n".join(response))
+
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def approve(self, ctx, user_id: int, *, reason: str):
+        rows = await approve_user_deposits(ctx.guild.id, user_id, reason)
+        if not rows:
+            await send_embed(ctx, "Error", "❌ No matching deposit requests found.")
+            return
     
-    await send_embed(ctx, "Transaction History", f"📜 {ctx.author.mention}, transactions for {member.mention}:\n{history_text}")
-
+        await send_embed(ctx, "Approval", f"✅ Approved deposits for <@{user_id}>.")
+        await send_dm(self.bot, user_id, f"✅ Your deposits have been approved!")
 
-#Admin Command: Remove any user's transaction history.
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def remove(ctx, currency: str, amount: int, *members: discord.Member):
-    if not members:
-        await send_embed(ctx, "Error", "You must specify at least one member.")
-        return
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def reject(self, ctx, user_id: int, *, reason: str = "No reason provided"):
+        await reject_user_deposits(ctx.guild.id, user_id, reason)
+    
+        await send_embed(ctx, "Rejection", f"❌ Rejected deposits for <@{user_id}>.")
+        await send_dm(self.bot, user_id, f"❌ Your deposit request was rejected. Reason: {reason}")
 
-    for member in members:
-        user_id = member.id
-        current_balance = get_balance(user_id, currency)
+    # Admin Command: Pay a fixed amount to everyone or to a role on a schedule.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def add_payout(self, ctx, currency: str, amount: int, interval: str, role: typing.Optional[discord.Role] = None, *, reason: str = "Scheduled payout"):
+        currency = currency.upper()
+        if currency not in CURRENCY_TYPES:
+            await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+            return
+        if amount <= 0:
+            await send_embed(ctx, "Error", "❌ The amount must be greater than 0.")
+            return
+        await self.create_schedule(ctx, "payout", currency, amount, interval, role, reason)
 
-        if current_balance == 0:
-            await send_embed(ctx, "Error", f"{member.mention} already has 0 {currency}. Cannot remove more.")
-            continue  # Skip this user and move to the next
+    # Admin Command: Apply interest (or decay, if negative) to balances on a schedule.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def add_interest(self, ctx, currency: str, percent: float, interval: str, role: typing.Optional[discord.Role] = None, *, reason: str = "Scheduled interest"):
+        currency = currency.upper()
+        if currency not in CURRENCY_TYPES:
+            await send_embed(ctx, "Error", f"❌ Invalid currency type! Use one of: {', '.join(CURRENCY_TYPES)}")
+            return
+        basis_points = round(percent * 100)
+        if basis_points == 0 or not -10000 <= basis_points <= 10000:
+            await send_embed(ctx, "Error", "❌ The rate must be between -100% and 100%, in steps of 0.01%.")
+            return
+        await self.create_schedule(ctx, "interest", currency, basis_points, interval, role, reason)
+
+    async def create_schedule(self, ctx, kind, currency, amount, interval, role, reason):
+        interval_ms = parse_interval(interval)
+        first_run = now_ms() + interval_ms
+        schedule_id = await add_payout_schedule(ctx.guild.id, kind, currency, amount, role and role.id, interval_ms,
+                                                first_run, reason, ctx.author.id)
+        payout_next_due.pop(ctx.guild.id, None)
+        await send_embed(ctx, "Scheduled", f"🗓️ Schedule #{schedule_id}: {describe_payout(kind, currency, amount, role and role.id)}, "
+                                           f"{format_interval(interval_ms)}. First run {format_timestamp(first_run)}.")
+
+    # Admin Command: List the payout schedules.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def view_payouts(self, ctx):
+        schedules = await get_payout_schedules(ctx.guild.id)
+        if not schedules:
+            await send_embed(ctx, "Payouts", "🗓️ No scheduled payouts.")
+            return
+        lines = []
+        for schedule_id, kind, currency, amount, role_id, interval_ms, next_run, reason, ran_at, users, total in schedules:
+            line = (f"**#{schedule_id}** {describe_payout(kind, currency, amount, role_id)}, {format_interval(interval_ms)} - *{reason}*\n"
+                    f"Next run {format_timestamp(next_run)}")
+            if ran_at is not None:
+                line += f"; last run {format_timestamp(ran_at)}: {total:,} {currency} to {users:,} users"
+            lines.append(line)
+        await send_embed(ctx, "Payouts", "\n".join(lines))
+
+    # Admin Command: Stop a payout schedule.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def remove_payout(self, ctx, schedule_id: int):
+        if not await remove_payout_schedule(ctx.guild.id, schedule_id):
+            await send_embed(ctx, "Error", f"❌ There is no active schedule #{schedule_id}.")
+            return
+        payout_next_due.pop(ctx.guild.id, None)
+        await send_embed(ctx, "Payouts", f"🗓️ Schedule #{schedule_id} has been stopped.")
+
+
+# Operator tools, plus the metrics endpoint and the scheduled reconciliation
+class Operations(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.metrics_runner = None
+
+    async def cog_load(self):
+        if METRICS_PORT is not None:
+            self.metrics_runner = await start_metrics_server()
+        self.scheduled_reconciliation.start()
+        self.payout_scheduler.start()
+
+    async def cog_unload(self):
+        self.scheduled_reconciliation.cancel()
+        self.payout_scheduler.cancel()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+
+    # Every guild of this process's shards that has a database
+    @tasks.loop(hours=RECONCILE_INTERVAL_HOURS)
+    async def scheduled_reconciliation(self):
+        for guild in self.bot.guilds:
+            if not os.path.exists(database_paths(guild.id)[0]):
+                continue
+            try:
+                report = await run_reconciliation(guild.id)
+            except Exception as error:
+                print(f"Reconciliation of guild {guild.id} failed: {error}")
+                continue
+            print(f"Reconciliation of guild {guild.id}: {report['rows']:,} ledger rows for {report['users']:,} users "
+                  f"in {report['seconds']} s, {len(report['drift'])} drifted balances")
+
+    @scheduled_reconciliation.before_loop
+    async def wait_for_guilds(self):
+        await self.bot.wait_until_ready()
+
+    # Scheduled payouts of every guild of this process's shards that has a database
+    @tasks.loop(seconds=PAYOUT_POLL_SECONDS)
+    async def payout_scheduler(self):
+        now = now_ms()
+        for guild in self.bot.guilds:
+            if not os.path.exists(database_paths(guild.id)[0]):
+                continue
+            try:
+                if guild.id not in payout_next_due:
+                    payout_next_due[guild.id] = await next_payout_due(guild.id)
+                due = payout_next_due[guild.id]
+                if due is not None and due <= now:
+                    await run_due_payouts(guild, now)
+                    payout_next_due[guild.id] = await next_payout_due(guild.id)
+            except Exception as error:
+                print(f"Scheduled payouts of guild {guild.id} failed: {error}")
+
+    @payout_scheduler.before_loop
+    async def wait_for_payout_guilds(self):
+        await self.bot.wait_until_ready()
+
+    # Admin Command: Show latency statistics.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def perfstats(self, ctx):
+        def summarize(kind):
+            # Busiest first, at most 10 rows so the embed field stays under 1024 characters
+            rows = sorted(metrics[kind].items(), key=lambda item: item[1].count, reverse=True)[:10]
+            if not rows:
+                return "No data yet."
+            return "\n".join(f"`{name}` - {h.count:,} calls, avg {h.total / h.count * 1000:.1f} ms, "
+                             f"p50 ≤{h.quantile(0.5) * 1000:g} ms, p99 ≤{h.quantile(0.99) * 1000:g} ms" for name, h in rows)
+
+        cache = balance_cache_info()
+        commits = commit_stats_info()
+        embed = discord.Embed(title="Tokyo Banking", color=0xce2222)
+        embed.add_field(name="Commands", value=summarize("command"), inline=False)
+        embed.add_field(name="Database", value=summarize("db"), inline=False)
+        embed.add_field(name="Messages", value=summarize("send"), inline=False)
+        embed.add_field(name="Balance Cache", value=f"{cache['hits']:,} hits, {cache['misses']:,} misses, {cache['size']:,}/{cache['max_size']:,} rows", inline=False)
+        embed.add_field(name="Group Commits", value=f"{commits['commits']:,} commits, {commits['writes']:,} writes, average batch {commits['average_batch']}, max batch {commits['max_batch']}", inline=False)
+        embed.add_field(name="Admission", value=f"{admission_stats['admitted']:,} admitted, {admission_stats['throttled']:,} throttled, "
+                                                f"{admission_stats['busy']:,} turned away busy, {admission_stats['in_flight']} in flight, "
+                                                f"{admission_stats['waiting']} waiting", inline=False)
+        if command_errors:
+            embed.add_field(name="Errors", value=", ".join(f"`{name}`: {count}" for name, count in sorted(command_errors.items())), inline=False)
+        await ctx.send(embed=embed)
+
+    # Admin Command: Move old settled transactions out of the hot table.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def archive(self, ctx, days: int = ARCHIVE_AFTER_DAYS, compact: bool = False):
+        if days < 1:
+            await send_embed(ctx, "Error", "❌ The number of days must be at least 1.")
+            return
 
-        new_balance = max(0, current_balance - amount)
-        c.execute("UPDATE users SET {}=? WHERE user_id=?".format(currency), (new_balance, user_id))
-        conn.commit()
-        log_transaction(user_id, "admin_remove", -amount, currency, f"Removed by {ctx.author.name}")
-        currency_symbol = "¥" if currency == "YEN" else ""
-        formatted_amount = f"{currency_symbol}{amount:,}" if currency == "YEN" else f"{amount:,} {currency}"
-        formatted_balance = f"{currency_symbol}{new_balance:,}" if currency == "YEN" else f"{new_balance:,} {currency}"
-        await send_embed(ctx, "Admin Action", 
-                         f"{formatted_amount} {currency} removed from {member.mention}.\n"
-                         f"New balance: {formatted_balance}.")
-
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def approve(ctx, user_id: int, *, reason: str):
-    c.execute("SELECT currency, amount FROM transactions WHERE user_id=? AND reason=? AND type='deposit' AND status IS NULL", (user_id, reason))
-    rows = c.fetchall()
-    if not rows:
-        await send_embed(ctx, "Error", "❌ No matching deposit requests found.")
+        cutoff = now_ms() - days * 86_400_000
+        moved = await archive_transactions(ctx.guild.id, cutoff)
+        message = f"🗄️ Archived {moved:,} settled transactions older than {days} days (before {format_timestamp(cutoff)})."
+        if compact:
+            await compact_database(ctx.guild.id)
+            message += "\nThe database file has been compacted."
+        await send_embed(ctx, "Archive", message)
+
+    # Admin Command: Check every balance against the transaction log.
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def reconcile(self, ctx, repair: bool = False, full: bool = False):
+        report = await run_reconciliation(ctx.guild.id, repair, full)
+        start = "the full ledger" if report["snapshot"] is None else f"snapshot #{report['snapshot']}"
+        lines = [f"Replayed {report['rows']:,} ledger rows for {report['users']:,} users from {start} in {report['seconds']} s."]
+        drift = report["drift"]
+        if not drift:
+            lines.append("✅ Every balance matches the ledger.")
+        else:
+            lines.append(f"⚠️ {len(drift)} balances differ from the ledger:")
+            lines += [f"<@{user_id}> {currency}: ledger {expected:,}, balance {actual:,} ({actual - expected:+,})"
+                      for user_id, currency, expected, actual in drift[:15]]
+            if len(drift) > 15:
+                lines.append(f"...and {len(drift) - 15} more.")
+            if repair:
+                lines.append(f"🛠️ Logged {len(drift)} adjustments so the ledger matches the balances.")
+            else:
+                lines.append("Run `!reconcile yes` to log adjustments for them.")
+        if report["new_snapshot"] is not None:
+            lines.append(f"📸 Took snapshot #{report['new_snapshot']}.")
+        await send_embed(ctx, "Reconciliation", "\n".join(lines))
+
+
+# Settings taken from a run_discord_bot config mapping, falling back to the environment
+# variables read above. Applied before the bot starts, so no database has been opened yet.
+def configure(config):
+    global DB_DIRECTORY, DB_PATH, ARCHIVE_PATH, LEGACY_GUILD_ID, METRICS_PORT
+    DB_DIRECTORY = config.get("db_dir", DB_DIRECTORY)
+    if "db_path" in config:
+        DB_PATH = config["db_path"]
+        ARCHIVE_PATH = os.path.splitext(DB_PATH)[0] + "-archive.db"
+    ARCHIVE_PATH = config.get("archive_path", ARCHIVE_PATH)
+    if config.get("legacy_guild") is not None:
+        LEGACY_GUILD_ID = int(config["legacy_guild"])
+    if "metrics_port" in config:
+        METRICS_PORT = None if config["metrics_port"] is None else int(config["metrics_port"])
+
+# Called once the gateway is ready. A bank.db from before per-guild storage is only served
+# for LEGACY_GUILD_ID; without it, every guild would silently start from empty balances. A
+# bot in a single guild (in one process) adopts the file for that guild, unless the guild
+# already has a database of its own; otherwise the file is left alone with a warning.
+def adopt_legacy_database(guilds):
+    global LEGACY_GUILD_ID
+    if LEGACY_GUILD_ID is not None or not os.path.exists(DB_PATH):
         return
-    
-    for currency, amount in rows:
-        c.execute(f"UPDATE users SET {currency} = {currency} + ? WHERE user_id = ?", (amount, user_id))
-    c.execute("UPDATE transactions SET status='approved' WHERE user_id=? AND reason=? AND type='deposit'", (user_id, reason))
-    conn.commit()
-    
-    user = await bot.fetch_user(user_id)
-    await send_embed(ctx, "Approval", f"✅ Approved deposits for <@{user_id}>.")
-    await user.send(f"✅ Your deposits have been approved!")
-
-@bot.command()
-@commands.has_permissions(administrator=True)
-async def reject(ctx, user_id: int, *, reason: str = "No reason provided"):
-    c.execute("UPDATE transactions SET status='rejected' WHERE user_id=? AND reason=? AND type='deposit' AND status IS NULL", (user_id, reason))
-    conn.commit()
-    
-    user = await bot.fetch_user(user_id)
-    await send_embed(ctx, "Rejection", f"❌ Rejected deposits for <@{user_id}>.")
-    await user.send(f"❌ Your deposit request was rejected. Reason: {reason}")
-
+    if SHARD_PROCESSES == 1 and len(guilds) == 1:
+        guild_id = guilds[0].id
+        if guild_id not in partitions and not os.path.exists(database_paths(guild_id)[0]):
+            LEGACY_GUILD_ID = guild_id
+            print(f"Serving {DB_PATH} as the bank of guild {guild_id}, the only guild; "
+                  f"set BANK_DB_GUILD={guild_id} to make this explicit.")
+            return
+    print(f"WARNING: {DB_PATH} holds a bank from before per-guild databases, but BANK_DB_GUILD is not set, "
+          f"so it is not used and guilds' balances start from {DB_DIRECTORY}/<guild_id>.db instead. "
+          f"Set BANK_DB_GUILD (or config['legacy_guild']) to the ID of the guild it belongs to.")
+
+# Fill the member and balance caches of every guild in the background once the gateway is
+# ready. Guilds aren't chunked at startup, so the bot answers commands before this finishes.
+async def warm_caches(bot):
+    started = time.perf_counter()
+    members = balances = 0
+    for guild in list(bot.guilds):
+        try:
+            if not guild.chunked:
+                await guild.chunk(cache=True)
+            members += guild.member_count or 0
+            if os.path.exists(database_paths(guild.id)[0]):
+                balances += await warm_balance_cache(guild.id)
+        except Exception as error:
+            print(f"Warming the caches of guild {guild.id} failed: {error}")
+    print(f"Warmed caches for {len(bot.guilds)} guilds: {members:,} members, "
+          f"{balances:,} balances in {time.perf_counter() - started:.1f} s")
+
+# Build the bot with every cog and hook registered; nothing connects until it is run
+def create_bot(warm=True):
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.message_content = True
+    intents.messages = True
+    intents.guilds = True
+
+    shard_ids = None if SHARD_PROCESS is None else list(range(SHARD_PROCESS, SHARD_COUNT, SHARD_PROCESSES))
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=shard_ids,
+                                  chunk_guilds_at_startup=False)
+    # Every bank belongs to a guild, so no command works in DMs
+    bot.add_check(commands.guild_only().predicate)
+    bot.before_invoke(start_command_timer)
+    bot.after_invoke(stop_command_timer)
+    bot.add_listener(on_command_error)
+    warming = None
+    ready = False
+
+    @bot.event
+    async def setup_hook():
+        await bot.add_cog(UserCommands(bot))
+        await bot.add_cog(AdminCommands(bot))
+        await bot.add_cog(Operations(bot))
+
+    # on_ready fires again after a reconnect; the legacy bank.db is only looked at and the
+    # caches only warmed once
+    @bot.event
+    async def on_ready():
+        nonlocal warming, ready
+        print(f"Logged in as {bot.user} on {len(bot.guilds)} guilds")
+        if not ready:
+            ready = True
+            adopt_legacy_database(bot.guilds)
+        if warm and warming is None:
+            warming = asyncio.create_task(warm_caches(bot))
+
+    return bot
+
+# Start one copy of this file per shard process and wait for them all. The token and
+# database settings reach them through the environment.
+def run_shard_processes(token):
+    processes = []
+    for index in range(SHARD_PROCESSES):
+        env = dict(os.environ, BANK_SHARD_PROCESS=str(index), BANK_SHARD_COUNT=str(SHARD_COUNT or SHARD_PROCESSES),
+                   DISCORD_TOKEN=token, BANK_DB_DIR=DB_DIRECTORY, BANK_DB_PATH=DB_PATH, BANK_ARCHIVE_PATH=ARCHIVE_PATH)
+        if LEGACY_GUILD_ID is not None:
+            env["BANK_DB_GUILD"] = str(LEGACY_GUILD_ID)
+        env["BANK_METRICS_PORT"] = "off" if METRICS_PORT is None else str(METRICS_PORT)
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    for process in processes:
+        process.wait()
+
+# Entry point. config may hold token, db_path, archive_path, db_dir, legacy_guild,
+# metrics_port (None disables the endpoint) and warm_caches (default True); anything
+# missing comes from the environment, the token from DISCORD_TOKEN.
+def run_discord_bot(config=None):
+    config = config or {}
+    token = config.get("token") or os.environ.get("DISCORD_TOKEN")
+    if not token:
+        raise RuntimeError("No bot token: pass config['token'] or set DISCORD_TOKEN")
+    configure(config)
+    if SHARD_PROCESSES > 1 and SHARD_PROCESS is None:
+        run_shard_processes(token)
+    else:
+        create_bot(warm=config.get("warm_caches", True)).run(token)
 
 
 # Run bot
-bot.run("")
+if __name__ == "__main__":
+    run_discord_bot()
@@ -0,0 +1,230 @@
+"""Offline load test for the bank commands.
+
+Runs the real bank commands from TokyoGhoul.py's cogs against a throwaway database with
+stand-in Discord objects, so no token or network connection is needed:
+
+    python benchmark.py --users 100000 --transactions 1000000 --concurrency 50
+
+Prints throughput, p50/p99 latency and memory allocated per command. With --json the
+report is written as JSON (for CI), and --max-p99 makes the run fail on a regression.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+COMMANDS = ["deposit", "spend", "transfer", "approve_deposit", "giveall", "history", "leaderboard"]
+
+
+# Stand-ins for the parts of discord.py objects the commands use
+class FakePermissions:
+    administrator = True
+
+class FakeMember:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+        self.guild_permissions = FakePermissions()
+
+    async def send(self, *args, **kwargs):
+        pass
+
+class FakeGuild:
+    id = 1
+
+    # Every ID resolves, as if the whole economy were in this guild
+    def get_member(self, user_id):
+        return FakeMember(user_id)
+
+class FakeChannel:
+    id = 1
+
+class FakeContext:
+    def __init__(self, author, guild):
+        self.author = author
+        self.guild = guild
+        self.channel = FakeChannel()
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+# Fill the users table and the ledger directly, in large batches (on the guild's database thread)
+def seed(bank, users, transactions):
+    c = bank.db.c
+    c.execute("BEGIN")
+    for start in range(1, users + 1, 50000):
+        c.executemany("INSERT INTO users (user_id, AP, SP, yen, reputation) VALUES (?, 100, 100, 1000000, 0)",
+                      [(user_id,) for user_id in range(start, min(start + 50000, users + 1))])
+    for start in range(0, transactions, 50000):
+        c.executemany("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      [(random.randint(1, users), "spend", 1, "YEN", "seed", 1704067200000, None)
+                       for _ in range(start, min(start + 50000, transactions))])
+    c.execute("COMMIT")
+
+
+class Benchmark:
+    def __init__(self, bank, args):
+        self.bank = bank
+        self.args = args
+        self.guild = FakeGuild()
+        self.admin = FakeMember(0)
+        self.pending_ids = []
+        # Command callbacks bound to their cogs; no bot, as the commands benchmarked here never send DMs
+        cogs = [bank.UserCommands(None), bank.AdminCommands(None)]
+        self.commands = {command.name: functools.partial(command.callback, cog) for cog in cogs for command in cog.get_commands()}
+
+    def ctx(self, author=None):
+        return FakeContext(author or self.admin, self.guild)
+
+    def random_member(self):
+        return FakeMember(random.randint(1, self.args.users))
+
+    # One invocation of each command, with realistic arguments
+    async def deposit(self):
+        await self.commands["deposit"](self.ctx(self.random_member()), "yen,ap", "100,5", reason="benchmark")
+
+    async def spend(self):
+        await self.commands["spend"](self.ctx(self.random_member()), "yen", 1, reason="benchmark")
+
+    async def transfer(self):
+        sender = self.random_member()
+        receiver = self.random_member()
+        if sender.id == receiver.id:
+            receiver = FakeMember(sender.id % self.args.users + 1)
+        await self.commands["transfer"](self.ctx(sender), receiver, 1)
+
+    async def approve_deposit(self):
+        batch = self.pending_ids[:self.args.approve_batch]
+        del self.pending_ids[:self.args.approve_batch]
+        await self.commands["approve_deposit"](self.ctx(), ",".join(map(str, batch)) or "0", True)
+
+    async def giveall(self):
+        await self.commands["giveall"](self.ctx(), "yen", 1)
+
+    async def history(self):
+        await self.commands["history"](self.ctx(self.random_member()), 10)
+
+    async def leaderboard(self):
+        await self.commands["leaderboard"](self.ctx(self.random_member()), "yen", 10)
+
+    async def prepare_approvals(self, operations):
+        def work():
+            c = self.bank.db.c
+            c.execute("BEGIN")
+            c.executemany("INSERT INTO transactions (user_id, type, amount, currency, reason, timestamp, status) VALUES (?, 'deposit', 10, 'YEN', 'benchmark', 1704067200000, 'PENDING')",
+                          [(random.randint(1, self.args.users),) for _ in range(operations * self.args.approve_batch)])
+            c.execute("SELECT id FROM transactions WHERE status='PENDING' ORDER BY id")
+            ids = [row[0] for row in c.fetchall()]
+            c.execute("COMMIT")
+            return ids
+        self.pending_ids = await self.bank.run_db(self.guild.id, work)
+
+    # Run operations calls of one command with at most concurrency in flight
+    async def run(self, name, operations):
+        command = getattr(self, name)
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                await command()
+                latencies.append(time.perf_counter() - started)
+
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        started = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(operations)])
+        await self.bank.flush_outbound()
+        elapsed = time.perf_counter() - started
+        allocated = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename") if stat.size_diff > 0)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {
+            "command": name,
+            "operations": operations,
+            "seconds": round(elapsed, 4),
+            "ops_per_second": round(operations / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "allocated_kib_per_op": round(allocated / operations / 1024, 2),
+            "peak_kib": round(peak / 1024, 1),
+        }
+
+
+async def main(args):
+    # The stand-in guild's bank is the database file given on the command line
+    os.environ["BANK_DB_PATH"] = args.database
+    os.environ["BANK_DB_GUILD"] = str(FakeGuild.id)
+    import TokyoGhoul as bank
+    # The stand-in channel has no Discord rate limit to respect
+    bank.CHANNEL_RATE_LIMIT = sys.maxsize
+
+    print(f"Seeding {args.users:,} users and {args.transactions:,} transactions...", file=sys.stderr)
+    await bank.run_db(FakeGuild.id, seed, bank, args.users, args.transactions)
+
+    benchmark = Benchmark(bank, args)
+    results = []
+    for name in args.commands:
+        operations = args.bulk_operations if name == "giveall" else args.operations
+        if name == "approve_deposit":
+            await benchmark.prepare_approvals(operations)
+        results.append(await benchmark.run(name, operations))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=10000, help="ledger rows to seed")
+    parser.add_argument("--operations", type=int, default=1000, help="calls per command")
+    parser.add_argument("--bulk-operations", type=int, default=5, help="calls of giveall, which touches every user")
+    parser.add_argument("--approve-batch", type=int, default=10, help="transaction IDs per approve_deposit call")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--commands", nargs="+", choices=COMMANDS, default=COMMANDS)
+    parser.add_argument("--database", help="database file to create (default: a temporary file)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    parser.add_argument("--max-p99", type=float, metavar="MS", help="exit with status 1 if any command's p99 exceeds this")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        if args.database is None:
+            args.database = os.path.join(directory, "benchmark.db")
+        elif os.path.exists(args.database):
+            sys.exit(f"{args.database} already exists; pick a new path")
+        results = asyncio.run(main(args))
+
+    print(f"{'command':<16}{'ops':>8}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'KiB/op':>10}{'peak KiB':>11}")
+    for r in results:
+        print(f"{r['command']:<16}{r['operations']:>8}{r['ops_per_second']:>12}{r['p50_ms']:>10}{r['p99_ms']:>10}"
+              f"{r['allocated_kib_per_op']:>10}{r['peak_kib']:>11}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.max_p99 is not None and any(r["p99_ms"] > args.max_p99 for r in results):
+        sys.exit(1)
@@ -0,0 +1,208 @@
+"""Bulk export and import for the bank database.
+
+Streams the users and transactions tables to and from CSV or JSONL files one row at a
+time, so even a million-row economy never has to fit in memory:
+
+    python bulk.py export bank.db users users.csv.gz
+    python bulk.py export bank.db transactions ledger.jsonl.gz
+    python bulk.py import bank.db users users.csv.gz
+
+Exports are always gzipped and read through their own read-only connection, so they can
+run next to the bot. A transactions export lists scheduled payouts per user, so importing
+it into an empty bank reproduces the balances. Imports accept plain or gzipped files and go through the bot's
+import_table (see TokyoGhoul.py), which keeps the ledger, balances and economy totals in
+step; run them while the bot is stopped, since it caches balances. The bot's !export and
+!import commands do the same for their guild.
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+
+from ledger import CURRENCY_COLUMNS, CURRENCY_TYPES, PAYOUT_CREDIT_TYPE, connect_readonly
+
+# Columns of each table, in file order. Exported transactions carry their ID, which
+# imports ignore: imported rows are appended to the ledger under new IDs.
+COLUMNS = {
+    "users": ["user_id", *CURRENCY_COLUMNS.values()],
+    "transactions": ["id", "user_id", "type", "amount", "currency", "reason", "timestamp", "status"],
+}
+FORMATS = ["csv", "jsonl"]
+FETCH_SIZE = 5000  # rows pulled from SQLite per fetchmany
+
+# Format of a file from its name, e.g. users.csv.gz -> csv
+def file_format(filename):
+    name = filename.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    for fmt, extensions in (("csv", (".csv",)), ("jsonl", (".jsonl", ".ndjson"))):
+        if name.endswith(extensions):
+            return fmt
+    raise ValueError(f"{filename} is not a .csv or .jsonl file (optionally .gz)")
+
+
+# Export pipeline: table_rows -> encode -> gzip file
+
+# Every row of a table, a fetchmany batch at a time. Transactions come from the live
+# table and the archive, in ID order, so that replaying them adds up to the balances:
+# scheduled payouts are exported as one 'payout' row per user (under the ID of the run's
+# summary row, which has no user and is left out), and credits already folded into the
+# summaries as one row per user and currency (without an ID, so they sort first).
+def table_rows(conn, table, attached=False):
+    if table == "users":
+        query = f"SELECT user_id, {', '.join(CURRENCY_COLUMNS.values())} FROM users ORDER BY user_id"
+    else:
+        columns = "id, user_id, type, amount, currency, reason, timestamp, status"
+        query = f"SELECT {columns} FROM main.transactions WHERE user_id IS NOT NULL"
+        if attached:
+            query += f" UNION ALL SELECT {columns} FROM archive.transactions WHERE user_id IS NOT NULL"
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'payout_credits'").fetchone():
+            query += (" UNION ALL SELECT r.ledger_id, c.user_id, 'payout', c.amount, r.currency,"
+                      " 'Scheduled payout (schedule #' || r.schedule_id || ')', r.ran_at, NULL"
+                      " FROM payout_runs r CROSS JOIN payout_credits c ON c.run_id = r.id"
+                      " UNION ALL SELECT NULL, user_id, 'payout', total, currency, 'Archived scheduled payouts', archived_through, NULL"
+                      f" FROM transaction_summaries WHERE type = '{PAYOUT_CREDIT_TYPE}'")
+        query += " ORDER BY id"
+    cursor = conn.execute(query)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+# Text for rows, one line each; CSV starts with a header row and comes out in ~64 KiB blocks
+def encode(rows, columns, fmt):
+    if fmt == "jsonl":
+        for row in rows:
+            yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# Writes a table to a gzipped file inside one read transaction, so the file is a
+# consistent snapshot even while the bot keeps writing. Returns the number of rows.
+def export_table(db_path, archive_path, table, fmt, path):
+    conn, attached = connect_readonly(db_path, archive_path)
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    try:
+        conn.execute("BEGIN")
+        with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+            f.writelines(encode(counted(table_rows(conn, table, attached)), COLUMNS[table], fmt))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return count
+
+
+# Import pipeline: read_rows -> chunked -> executemany (in TokyoGhoul.import_table)
+
+def _open_text(path):
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    if compressed:
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+def _integer(value):
+    if value is None or value == "":
+        return 0
+    return int(value)
+
+def _user(record):
+    return (int(record["user_id"]), _integer(record.get("ap")), _integer(record.get("sp")),
+            _integer(record.get("yen")), _integer(record.get("reputation")))
+
+def _transaction(record):
+    currency = str(record["currency"])
+    if currency.upper() not in CURRENCY_TYPES:
+        raise ValueError(f"unknown currency {currency!r}")
+    trans_type = str(record["type"] or "")
+    if not trans_type:
+        raise ValueError("missing type")
+    if trans_type == PAYOUT_CREDIT_TYPE:
+        raise ValueError(f"type {trans_type!r} is reserved")
+    return (int(record["user_id"]), trans_type, int(record["amount"]), currency,
+            record.get("reason") or "", int(record["timestamp"]), record.get("status") or None)
+
+# Validated rows of a file, in file order: (user_id, AP, SP, yen, reputation) for users,
+# (user_id, type, amount, currency, reason, timestamp, status) for transactions.
+# Column names are matched case-insensitively and extra columns are ignored.
+def read_rows(path, table, fmt):
+    parse = _user if table == "users" else _transaction
+    with _open_text(path) as f:
+        if fmt == "csv":
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for number, record in enumerate(records, start=1):
+            try:
+                yield parse({key.lower(): value for key, value in record.items() if isinstance(key, str)})
+            except KeyError as error:
+                raise ValueError(f"{table} record {number}: missing {error}") from None
+            except (AttributeError, TypeError, ValueError) as error:
+                raise ValueError(f"{table} record {number}: {error}") from None
+
+# Lists of up to size items from an iterable
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("database", help="bank database file")
+    parser.add_argument("table", choices=list(COLUMNS))
+    parser.add_argument("file", help="file to write (export) or read (import)")
+    parser.add_argument("--format", choices=FORMATS, help="file format (default: from the file name)")
+    parser.add_argument("--archive", help="archive database (default: <database>-archive.db)")
+    parser.add_argument("--reason", default="Bulk import", help="reason logged on the ledger rows of a users import")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.archive is None:
+        args.archive = os.path.splitext(args.database)[0] + "-archive.db"
+    fmt = args.format or file_format(args.file)
+
+    if args.action == "export":
+        if not os.path.exists(args.database):
+            sys.exit(f"{args.database} does not exist")
+        count = export_table(args.database, args.archive, args.table, fmt, args.file)
+        print(f"Exported {count:,} {args.table} rows to {args.file}")
+    else:
+        # The file is served as the bank of a stand-in guild 0, so the import runs through
+        # the same migrations, worker thread and group commit as the bot's !import
+        import TokyoGhoul as bank
+        bank.configure({"db_path": args.database, "archive_path": args.archive, "legacy_guild": 0})
+        try:
+            count = asyncio.run(bank.import_table(0, args.table, fmt, args.file, args.reason))
+        except ValueError as error:
+            sys.exit(f"Nothing was imported: {error}")
+        print(f"Imported {count:,} {args.table} records from {args.file}")
@@ -0,0 +1,22 @@
+"""Definitions shared by the bot (TokyoGhoul.py) and the offline tools (reconcile.py, bulk.py)."""
+import os
+import pathlib
+import sqlite3
+
+CURRENCY_TYPES = ["AP", "SP", "YEN", "REPUTATION"]
+# Column of the users table holding each currency
+CURRENCY_COLUMNS = dict(zip(CURRENCY_TYPES, ["AP", "SP", "yen", "reputation"]))
+# Type of the transaction_summaries rows that payout credits are folded into when archived.
+# Reserved: imports may not use it, so imported ledger rows never mix with folded credits.
+PAYOUT_CREDIT_TYPE = "payout_credit"
+
+
+# Opens a bank database read-only, with its archive attached as archive if that file exists.
+# Extra options go to sqlite3.connect. Returns (connection, whether the archive is attached).
+def connect_readonly(db_path, archive_path=None, **options):
+    uri = pathlib.Path(db_path).resolve().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, isolation_level=None, **options)
+    attached = archive_path is not None and os.path.exists(archive_path)
+    if attached:
+        conn.execute("ATTACH DATABASE ? AS archive", (pathlib.Path(archive_path).resolve().as_uri() + "?mode=ro",))
+    return conn, attached
@@ -0,0 +1,184 @@
+"""Ledger reconciliation for the bank database.
+
+Replays the transactions log on top of the latest balance snapshot and compares the
+result with the users table, reporting every (user, currency) whose balance has drifted
+from its ledger. Users are split into partitions by user_id and each partition is
+replayed in its own process over its own read-only connection:
+
+    python reconcile.py bank.db --workers 8
+
+--full ignores snapshots and replays the whole ledger, using transaction_summaries for
+archived rows. The bot's !reconcile command runs the same engine and can repair drift.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ledger import CURRENCY_TYPES, PAYOUT_CREDIT_TYPE, connect_readonly
+
+MIN_USER_ID = -2 ** 63
+MAX_USER_ID = 2 ** 63 - 1
+
+# Balance change made by one ledger row. Deposits only count once approved, spends and
+# outgoing transfers are logged as positive amounts, and every other type (gives, incoming
+# transfers, removals, adjustments, payout credits) is logged with its sign.
+LEDGER_EFFECT = """CASE
+        WHEN type = 'deposit' THEN CASE WHEN UPPER(status) = 'APPROVED' THEN amount ELSE 0 END
+        WHEN type IN ('spend', 'transfer_out') THEN -amount
+        ELSE amount
+    END"""
+
+
+# What each user got from a scheduled payout run is kept in payout_credits rather than as
+# a ledger row, so it is replayed alongside the ledger. CROSS JOIN keeps the runs as the
+# outer loop, so each partition seeks its user_id range within each run.
+PAYOUT_CREDITS = f"""SELECT user_id, r.currency, '{PAYOUT_CREDIT_TYPE}', c.amount, NULL
+                    FROM payout_runs r CROSS JOIN payout_credits c ON c.run_id = r.id"""
+
+# Replays the users with low <= user_id < high inside a single read transaction, so
+# balances and ledger are seen as of the same commit. Returns
+# {"drift": [(user_id, currency, expected, actual)], "users": n, "rows": n, "snapshot": id or None}.
+def replay_partition(db_path, archive_path, low, high, full=False):
+    conn, attached = connect_readonly(db_path, archive_path)
+    c = conn.cursor()
+    # A user_id range, so each partition only reads its own rows through the user indexes
+    owned = "user_id >= ? AND user_id < ?"
+    try:
+        c.execute("BEGIN")
+        snapshot = None
+        if not full:
+            c.execute("SELECT id, through_id FROM balance_snapshots ORDER BY id DESC LIMIT 1")
+            snapshot = c.fetchone()
+
+        expected = {}
+        rows = 0
+
+        def add(user_id, currency, amount, count=0):
+            nonlocal rows
+            balances = expected.setdefault(user_id, dict.fromkeys(CURRENCY_TYPES, 0))
+            balances[currency] = balances.get(currency, 0) + amount
+            rows += count
+
+        if snapshot is None:
+            # Whole ledger: live rows and payout credits plus the per-status totals of archived ones
+            ledger = (f"SELECT user_id, currency, type, amount, status FROM main.transactions WHERE {owned} "
+                      f"UNION ALL SELECT user_id, currency, type, total, status FROM transaction_summaries WHERE {owned} "
+                      f"UNION ALL {PAYOUT_CREDITS} WHERE {owned}")
+            params = [low, high] * 3
+        else:
+            snapshot_id, through_id = snapshot
+            c.execute(f"SELECT user_id, AP, SP, yen, reputation FROM snapshot_balances WHERE snapshot_id = ? AND {owned}",
+                      (snapshot_id, low, high))
+            for user_id, *balances in c.fetchall():
+                for currency, amount in zip(CURRENCY_TYPES, balances):
+                    add(user_id, currency, amount)
+
+            # Rows logged after the snapshot, wherever they live now
+            tables = ["main.transactions"] + (["archive.transactions"] if attached else [])
+            ledger = " UNION ALL ".join(f"SELECT user_id, currency, type, amount, status FROM {table} WHERE id > ? AND {owned}" for table in tables)
+            # and the payout runs logged after it
+            ledger += f" UNION ALL {PAYOUT_CREDITS} WHERE r.ledger_id > ? AND {owned}"
+            params = [through_id, low, high] * (len(tables) + 1)
+
+            # Deposits that were still pending at the snapshot count from when they were approved
+            for table in tables:
+                c.execute(f"""SELECT t.user_id, UPPER(t.currency), SUM(t.amount), COUNT(*)
+                              FROM snapshot_pending p JOIN {table} t ON t.id = p.transaction_id
+                              WHERE p.snapshot_id = ? AND UPPER(t.status) = 'APPROVED' AND t.user_id >= ? AND t.user_id < ?
+                              GROUP BY t.user_id, UPPER(t.currency)""", (snapshot_id, low, high))
+                for user_id, currency, amount, count in c.fetchall():
+                    add(user_id, currency, amount, count)
+
+        c.execute(f"SELECT user_id, UPPER(currency), SUM({LEDGER_EFFECT}), COUNT(*) FROM ({ledger}) "
+                  f"GROUP BY user_id, UPPER(currency)", params)
+        for user_id, currency, amount, count in c.fetchall():
+            add(user_id, currency, amount, count)
+
+        c.execute(f"SELECT user_id, AP, SP, yen, reputation FROM users WHERE {owned}", (low, high))
+        actual = {user_id: dict(zip(CURRENCY_TYPES, balances)) for user_id, *balances in c.fetchall()}
+        c.execute("COMMIT")
+    finally:
+        conn.close()
+
+    drift = []
+    for user_id in sorted(expected.keys() | actual.keys()):
+        want = expected.get(user_id, {})
+        have = actual.get(user_id, {})
+        for currency in CURRENCY_TYPES:
+            if want.get(currency, 0) != have.get(currency, 0):
+                drift.append((user_id, currency, want.get(currency, 0), have.get(currency, 0)))
+    return {"drift": drift, "users": len(actual), "rows": rows, "snapshot": snapshot and snapshot[0]}
+
+
+# Process pool for replaying partitions. Workers are spawned rather than forked, since
+# forking a process that has a database thread mid-query can deadlock the child.
+def make_executor(workers):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+# Splits the user_id space into ranges holding about the same number of users. The first
+# and last ranges are open-ended so users with ledger rows but no users row are covered too.
+def partition_bounds(db_path, partitions):
+    conn = connect_readonly(db_path)[0]
+    try:
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        bounds = [MIN_USER_ID]
+        for i in range(1, partitions):
+            row = conn.execute("SELECT user_id FROM users ORDER BY user_id LIMIT 1 OFFSET ?", (users * i // partitions,)).fetchone()
+            if row is not None and row[0] > bounds[-1]:
+                bounds.append(row[0])
+        bounds.append(MAX_USER_ID)
+    finally:
+        conn.close()
+    return list(zip(bounds, bounds[1:]))
+
+# Replays every partition on the executor and merges the results into
+# {"drift": [...], "users": n, "rows": n, "snapshot": id or None, "seconds": s}
+def reconcile(executor, db_path, archive_path, partitions, full=False):
+    started = time.perf_counter()
+    futures = [executor.submit(replay_partition, db_path, archive_path, low, high, full)
+               for low, high in partition_bounds(db_path, partitions)]
+    report = {"drift": [], "users": 0, "rows": 0, "snapshot": None}
+    for future in futures:
+        result = future.result()
+        report["drift"].extend(result["drift"])
+        report["users"] += result["users"]
+        report["rows"] += result["rows"]
+        report["snapshot"] = result["snapshot"]
+    report["drift"].sort()
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("database", help="bank database file")
+    parser.add_argument("--archive", help="archive database (default: <database>-archive.db)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes to replay partitions in")
+    parser.add_argument("--full", action="store_true", help="replay the whole ledger instead of starting from the latest snapshot")
+    parser.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.archive is None:
+        args.archive = os.path.splitext(args.database)[0] + "-archive.db"
+    with make_executor(args.workers) as executor:
+        report = reconcile(executor, args.database, args.archive, args.workers * 4, args.full)
+
+    start = "the full ledger" if report["snapshot"] is None else f"snapshot {report['snapshot']}"
+    print(f"Replayed {report['rows']:,} ledger rows for {report['users']:,} users from {start} in {report['seconds']} s")
+    print(f"{'user_id':>20}  {'currency':<11}{'ledger':>14}{'balance':>14}{'drift':>14}")
+    for user_id, currency, expected, actual in report["drift"]:
+        print(f"{user_id:>20}  {currency:<11}{expected:>14}{actual:>14}{actual - expected:>14}")
+    print(f"{len(report['drift'])} drifted balances")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    sys.exit(1 if report["drift"] else 0)
@@ -0,0 +1,47 @@
+import asyncio
+import sqlite3
+
+import TokyoGhoul as bank
+
+
+# A COMMIT that fails must fail every unit of work in its transaction, including units
+# whose commit waiters only register after that batch was flushed
+def test_failed_group_commit_fails_every_unit_in_it(tmp_path, monkeypatch):
+    monkeypatch.setattr(bank, "DB_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(bank, "LEGACY_GUILD_ID", None)
+    # Flush on every waiter, so later units keep joining the transaction being committed
+    monkeypatch.setattr(bank, "COMMIT_BATCH_SIZE", 1)
+    guild_id = 4242
+
+    # Denies the first COMMIT, which the committer then rolls back
+    def deny_first_commit():
+        denied = []
+
+        def authorizer(action, arg1, *args):
+            if action == sqlite3.SQLITE_TRANSACTION and arg1 == "COMMIT" and not denied:
+                denied.append(arg1)
+                return sqlite3.SQLITE_DENY
+            return sqlite3.SQLITE_OK
+        bank.db.conn.set_authorizer(authorizer)
+
+    async def run():
+        await bank.run_db(guild_id, deny_first_commit)
+        results = await asyncio.gather(*[bank.give_currency(guild_id, user_id, "YEN", 10, "admin_give", "test")
+                                         for user_id in range(1, 301)], return_exceptions=True)
+
+        def stored():
+            bank.db.c.execute("SELECT user_id, yen FROM users")
+            return dict(bank.db.c.fetchall())
+        balances = await bank.run_db(guild_id, stored)
+        for partition in list(bank.partitions.values()):
+            partition.close()
+        bank.partitions.clear()
+        return results, balances
+
+    results, balances = asyncio.run(run())
+    failed = [user_id for user_id, result in enumerate(results, start=1) if isinstance(result, Exception)]
+    acknowledged = [user_id for user_id, result in enumerate(results, start=1) if not isinstance(result, Exception)]
+    assert failed, "the denied COMMIT should have failed some gives"
+    # Every acknowledged give is stored, and no failed one is
+    assert [user_id for user_id in acknowledged if balances.get(user_id) != 10] == []
+    assert [user_id for user_id in failed if balances.get(user_id)] == []